@@ -1,15 +1,46 @@
 """The database handler.
 """
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import reduce
+from math import ceil
+import bson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReturnDocument, UpdateOne
 from DbConnector import DbConnector
+from Profiler import profiler
+from RouteSignature import similarity
 
 
 class DbHandler:
     """The Database handler. Containing all functionality to interact with the database"""
 
-    def __init__(self):
-        self.connection = DbConnector()
+    def __init__(self, connection=None):
+        self.connection = connection if connection is not None else DbConnector()
         self.client = self.connection.client
         self.db = self.connection.db
+        # Read preference for heavy analytics, routing them away from the primary
+        self.analytics = self.connection.analytics_read_preference
+        # Time partitions written by this handler, their indexes are created on the first write
+        self.known_partitions = set()
+
+    def get_collection(self, collection_name, read_preference=None):
+        """Get a collection, optionally with another read preference than the primary
+
+        Args:
+            collection_name (str): Name of a collection
+            read_preference (ReadPreference, optional): e.g. self.analytics. Defaults to None.
+
+        Returns:
+            ~pymongo.collection.Collection: the collection
+        """
+        collection = self.db[collection_name]
+        if read_preference is not None:
+            collection = collection.with_options(read_preference=read_preference)
+        return collection
 
     def create_coll(self, collection_name):
         """Create a colletions in the DB
@@ -45,8 +76,17 @@ class DbHandler:
             list: inserted ids
         """
         collection = self.db[collection_name]
-        results = collection.insert_many(docs)
-        return results.inserted_ids
+        if not profiler.enabled:
+            return collection.insert_many(docs).inserted_ids
+
+        # Encode separately to measure it, insert_many does not encode raw documents.
+        # The ids of raw documents are not returned by insert_many, so they are set here.
+        with profiler.stage("encode"):
+            ids = [doc.setdefault("_id", ObjectId()) for doc in docs]
+            raw_docs = [RawBSONDocument(bson.encode(doc)) for doc in docs]
+        with profiler.stage("write"):
+            collection.insert_many(raw_docs)
+        return ids
 
     def update_document(self, collection_name, document_id, data):
         """Update a document in a collection
@@ -62,6 +102,90 @@ class DbHandler:
         collection = self.db[collection_name]
         collection.update_one({"_id": document_id}, {"$set": data}, upsert=False)
 
+    def push_to_array(self, collection_name, document_id, field, value, defaults=None):
+        """Append a value to an array in a document, without rewriting the array.
+        If defaults is provided, a missing document is created with these fields.
+
+        Args:
+            collection_name (str): name of the collection
+            document_id (ObjectID): id of the document
+            field (str): name of the array
+            value: value to append
+            defaults (dict, optional): fields of a new document. Defaults to None.
+        """
+        collection = self.db[collection_name]
+        update = {"$push": {field: value}}
+        if defaults is not None:
+            update["$setOnInsert"] = defaults
+        collection.update_one(
+            {"_id": document_id}, update, upsert=defaults is not None
+        )
+
+    def update_documents(self, collection_name, query, update, upsert=False) -> int:
+        """Update all documents matching a query with an update document or pipeline
+        Example of update = {"$set": {"field_name_to_update": new_value}}
+
+        Args:
+            collection_name (str): name of the collection
+            query (dict): the filter
+            update (dict | list): the update
+            upsert (bool, optional): insert a document if none match. Defaults to False.
+
+        Returns:
+            int: number of matched documents
+        """
+        collection = self.db[collection_name]
+        return collection.update_many(query, update, upsert=upsert).matched_count
+
+    def bulk_update(self, collection_name, updates: list, upsert=False) -> int:
+        """Send many updates to the server in one unordered batch
+        Example of updates = [({"_id": 1}, {"$inc": {"count": 1}}), ...]
+
+        Args:
+            collection_name (str): name of the collection
+            updates (list): (query, update) pairs
+            upsert (bool, optional): insert a document if none match. Defaults to False.
+
+        Returns:
+            int: number of matched and upserted documents
+        """
+        if len(updates) == 0:
+            return 0
+        collection = self.db[collection_name]
+        requests = [UpdateOne(query, update, upsert=upsert) for query, update in updates]
+        results = collection.bulk_write(requests, ordered=False)
+        return results.matched_count + results.upserted_count
+
+    def find_and_update(self, collection_name, query, update, sort=None):
+        """Atomically update one document matching a query, and return it
+
+        Args:
+            collection_name (str): name of the collection
+            query (dict): the filter
+            update (dict | list): the update
+            sort (list, optional): (field, direction) pairs to pick the document. Defaults to None.
+
+        Returns:
+            dict | None: the updated document, None if no document matched
+        """
+        collection = self.db[collection_name]
+        return collection.find_one_and_update(
+            query, update, sort=sort, return_document=ReturnDocument.AFTER
+        )
+
+    def delete_documents(self, collection_name, query) -> int:
+        """Delete all documents matching a query
+
+        Args:
+            collection_name (str): name of the collection
+            query (dict): the filter
+
+        Returns:
+            int: number of deleted documents
+        """
+        collection = self.db[collection_name]
+        return collection.delete_many(query).deleted_count
+
     def fetch_documents(self, collection_name) -> list:
         """Fetch all documents in a collection from the database
 
@@ -74,19 +198,20 @@ class DbHandler:
         collection = self.db[collection_name]
         return list(collection.find({}))
 
-    def get_nr_documents(self, collection_name) -> int:
+    def get_nr_documents(self, collection_name, read_preference=None) -> int:
         """Get number of documents in a collection
 
         Args:
             collection_name (str): Name of a collection
+            read_preference (ReadPreference, optional): where to read. Defaults to None (primary).
 
         Returns:
             int: number of documents for a given collection
         """
-        collection = self.db[collection_name]
+        collection = self.get_collection(collection_name, read_preference)
         return int(collection.count_documents({}))
 
-    def find_documents(self, collection_name, query={}, fields={}):
+    def find_documents(self, collection_name, query={}, fields={}, read_preference=None):
         """find documents in a given collection provided queries.
         You can spesificy which fields you would like in return as well.
 
@@ -98,20 +223,22 @@ class DbHandler:
             collection_name (_type_): _description_
             query (_type_): _description_
             fields (dict, optional): _description_. Defaults to {}.
+            read_preference (ReadPreference, optional): where to read. Defaults to None (primary).
 
         Returns:
             _type_: _description_
         """
-        collection = self.db[collection_name]
+        collection = self.get_collection(collection_name, read_preference)
         return collection.find(query, fields)
 
-    def aggregate(self, collection_name, pipeline: list):
+    def aggregate(self, collection_name, pipeline: list, read_preference=None):
         """Perform aggregation, and return computed results.
         Each stage is provided in the pipeline list
 
         Args:
             collection_name (str): Name of the collection
             pipeline (list): Stages in the aggregation
+            read_preference (ReadPreference, optional): where to read. Defaults to None (primary).
 
         Returns:
             ~pymongo.command_cursor.CommandCursor:
@@ -119,9 +246,476 @@ class DbHandler:
                 CommandCursor is iterable (for-each loop).
                 list(CommandCursor) to print the results.
         """
-        collection = self.db[collection_name]
+        collection = self.get_collection(collection_name, read_preference)
         return collection.aggregate(pipeline)
 
+    def create_index(self, collection_name, keys: list, **kwargs) -> str:
+        """Create an index on a collection
+        Example of keys = [("activity_id", 1), ("date_time", 1)]
+
+        Args:
+            collection_name (str): Name of the collection
+            keys (list): (field, direction) pairs
+
+        Returns:
+            str: name of the index
+        """
+        collection = self.db[collection_name]
+        return collection.create_index(keys, **kwargs)
+
+    def partition_bounds(
+        self, collection_name, key, partitions: int, query={}, read_preference=None
+    ) -> list:
+        """Find boundaries that split a collection into partitions of roughly equal size.
+        The boundaries are quantiles of the key in a random sample of the collection.
+        A time partitioned collection is sampled in every partition, proportional to its size.
+
+        Args:
+            collection_name (str): Name of the (time partitioned) collection
+            key (str): The (indexed) field to partition on
+            partitions (int): Number of partitions
+            query (dict, optional): only consider these documents. Defaults to {}.
+            read_preference (ReadPreference, optional): where to read. Defaults to None (primary).
+
+        Returns:
+            list: sorted, unique boundaries. At most partitions-1 elements
+        """
+        names = self.prune_partitions(collection_name)
+        sizes = [self.db[name].estimated_document_count() for name in names]
+        sample = []
+        for name, size in zip(names, sizes):
+            sample_size = ceil(partitions * 100 * size / max(sum(sizes), 1))
+            if sample_size == 0:
+                continue
+            pipeline = [
+                {"$match": query},
+                {"$sample": {"size": sample_size}},
+                {"$project": {"_id": 0, "key": "$" + key}},
+            ]
+            ret = self.aggregate(name, pipeline, read_preference)
+            sample += [doc["key"] for doc in ret]
+        sample.sort()
+        if len(sample) == 0:
+            return []
+
+        bounds = [sample[len(sample) * i // partitions] for i in range(1, partitions)]
+        return sorted(set(bounds))
+
+    def partitioned_scan(
+        self,
+        collection_name,
+        key,
+        mapper,
+        reducer,
+        query={},
+        fields={},
+        sort=None,
+        partitions=None,
+        read_preference=None,
+    ):
+        """Scan a collection in parallel.
+        The collection is split into disjoint ranges on the key, and each range is scanned
+        by a worker process with its own connection.
+        If the collection is time partitioned, a worker reads its range from every partition,
+        oldest first, so the documents of a key range are seen by one worker in time order.
+        The mapper computes a partial aggregate for a range, and the partial aggregates
+        are combined with the reducer.
+        The mapper and reducer must be defined at module level (picklable).
+
+        Example:
+            def mapper(documents): return {"n": sum(1 for _ in documents)}
+            def reducer(a, b): return {"n": a["n"] + b["n"]}
+            db.partitioned_scan("TrackPoint", "activity_id", mapper, reducer)
+
+        Args:
+            collection_name (str): Name of the (time partitioned) collection
+            key (str): The (indexed) field to partition on, e.g. activity_id or _id
+            mapper (Callable): documents -> partial aggregate
+            reducer (Callable): (partial, partial) -> partial
+            query (dict, optional): the filter. Defaults to {}.
+            fields (dict, optional): the projection. Defaults to {}.
+            sort (list, optional): (field, direction) pairs to sort each range on. Defaults to None.
+            partitions (int, optional): Number of partitions. Defaults to the number of CPUs.
+            read_preference (ReadPreference, optional): where to read. Defaults to None (primary).
+
+        Returns:
+            The combined aggregate
+        """
+        partitions = partitions if partitions is not None else os.cpu_count()
+        names = self.prune_partitions(collection_name)
+        bounds = self.partition_bounds(
+            collection_name, key, partitions, query, read_preference
+        )
+
+        # Disjoint ranges [lower, upper) covering the whole key space
+        ranges = zip([None] + bounds, bounds + [None])
+        queries = []
+        for lower, upper in ranges:
+            key_range = {}
+            if lower is not None:
+                key_range["$gte"] = lower
+            if upper is not None:
+                key_range["$lt"] = upper
+            queries.append({"$and": [query, {key: key_range}]} if key_range else query)
+
+        with ProcessPoolExecutor(max_workers=len(queries)) as executor:
+            futures = [
+                executor.submit(
+                    _scan_partition,
+                    (self.connection.uri, self.connection.database),
+                    names,
+                    q,
+                    fields,
+                    sort,
+                    mapper,
+                    read_preference,
+                )
+                for q in queries
+            ]
+            partials = [future.result() for future in futures]
+        return reduce(reducer, partials)
+
+    def time_bucketed_stats(
+        self, collection_name="Activity", buckets=("year",), query={}, read_preference=None
+    ) -> list:
+        """Count the activities and sum their duration per time bucket, on the server.
+        Uses the precomputed year/month and duration_seconds fields of the activities.
+
+        Example of a returned bucket with buckets=("year", "month"):
+        {"_id": {"year": 2008, "month": 6}, "count": 120, "hours": 85.5}
+
+        Args:
+            collection_name (str, optional): Name of the collection. Defaults to "Activity".
+            buckets (tuple, optional): fields to group on, "year" and/or "month".
+                Defaults to ("year",).
+            query (dict, optional): only consider these documents. Defaults to {}.
+            read_preference (ReadPreference, optional): where to read. Defaults to None (primary).
+
+        Returns:
+            list: the buckets, sorted by time
+        """
+        pipeline = []
+        if query:
+            pipeline.append({"$match": query})
+
+        # Sorting on the indexed fields allows a covered index scan
+        pipeline.append({"$sort": {bucket: 1 for bucket in buckets}})
+        pipeline.append(
+            {
+                "$group": {
+                    "_id": {bucket: "$" + bucket for bucket in buckets},
+                    "count": {"$sum": 1},
+                    "seconds": {"$sum": "$duration_seconds"},
+                }
+            }
+        )
+        pipeline.append(
+            {
+                "$project": {
+                    "count": 1,
+                    "hours": {"$divide": ["$seconds", 3600]},
+                }
+            }
+        )
+        pipeline.append({"$sort": {"_id": 1}})
+        return list(self.aggregate(collection_name, pipeline, read_preference))
+
+    def find_similar_activities(self, activity_id, k=10, read_preference=None) -> list:
+        """Find the activities following roughly the same route as an activity.
+        Candidates share a band of the route signature, found with the index on bands,
+        and are ranked by the estimated Jaccard similarity of the visited grid cells.
+
+        Args:
+            activity_id (ObjectID): id of the activity
+            k (int, optional): number of activities to return. Defaults to 10.
+            read_preference (ReadPreference, optional): where to read. Defaults to None (primary).
+
+        Raises:
+            ValueError: If the activity has no route signature
+
+        Returns:
+            list: [{"_id", "user_id", "similarity"}, ...], the most similar first
+        """
+        collection = self.get_collection("RouteSignature", read_preference)
+        signature = collection.find_one({"_id": activity_id})
+        if signature is None:
+            raise ValueError(f"Activity {activity_id} has no route signature")
+
+        candidates = collection.find(
+            {"bands": {"$in": signature["bands"]}, "_id": {"$ne": activity_id}},
+            {"user_id": 1, "minhash": 1},
+        )
+        similar = [
+            {
+                "_id": candidate["_id"],
+                "user_id": candidate["user_id"],
+                "similarity": similarity(candidate["minhash"], signature["minhash"]),
+            }
+            for candidate in candidates
+        ]
+        return sorted(similar, key=lambda x: x["similarity"], reverse=True)[:k]
+
+    @staticmethod
+    def partition_name(collection_name, date_time, granularity) -> str:
+        """The name of the time partition of a collection a document belongs to
+
+        Args:
+            collection_name (str): Name of the partitioned collection, e.g. TrackPoint
+            date_time (datetime): time of the document
+            granularity (str): "year" or "month"
+
+        Returns:
+            str: e.g. TrackPoint_2008 or TrackPoint_2008_06
+        """
+        if granularity == "year":
+            return f"{collection_name}_{date_time.year}"
+        return f"{collection_name}_{date_time.year}_{date_time.month:02}"
+
+    def insert_partitioned(
+        self, collection_name, docs: list, granularity, key="date_time", indexes=()
+    ) -> list:
+        """Insert documents into the time partitions of a collection.
+        The indexes are created the first time this handler writes to a partition,
+        so partitions created after the initial load (e.g. a new month) are indexed as well.
+
+        Args:
+            collection_name (str): Name of the partitioned collection
+            docs (list[dict]): Documents to be inserted
+            granularity (str): "year" or "month"
+            key (str, optional): the time field to partition on. Defaults to "date_time".
+            indexes (list, optional): keys of the indexes of every partition,
+                e.g. [[("activity_id", 1), ("date_time", 1)]]. Defaults to ().
+
+        Returns:
+            list: inserted ids, grouped by partition
+        """
+        partitions = {}
+        for doc in docs:
+            name = self.partition_name(collection_name, doc[key], granularity)
+            partitions.setdefault(name, []).append(doc)
+
+        ids = []
+        for name, partition_docs in partitions.items():
+            if name not in self.known_partitions:
+                for keys in indexes:
+                    self.create_index(name, keys)
+                self.known_partitions.add(name)
+            ids += self.insert_documents(name, partition_docs)
+        return ids
+
+    def get_partitions(self, collection_name) -> dict:
+        """Find the time partitions of a collection
+
+        Args:
+            collection_name (str): Name of the partitioned collection
+
+        Returns:
+            dict: partition name -> (start, end) of the partition, sorted by time
+        """
+        pattern = re.compile(rf"^{re.escape(collection_name)}_(\d{{4}})(?:_(\d{{2}}))?$")
+        partitions = {}
+        for name in self.db.list_collection_names():
+            match = pattern.match(name)
+            if match is None:
+                continue
+            year = int(match.group(1))
+            if match.group(2) is None:
+                start, end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+            else:
+                month = int(match.group(2))
+                start = datetime(year, month, 1)
+                end = datetime(year + month // 12, month % 12 + 1, 1)
+            partitions[name] = (start, end)
+        return dict(sorted(partitions.items(), key=lambda x: x[1]))
+
+    def prune_partitions(self, collection_name, start=None, end=None) -> list:
+        """Find the partitions of a collection overlapping a time range.
+        If the collection is not partitioned, the collection itself is returned.
+
+        Args:
+            collection_name (str): Name of the partitioned collection
+            start (datetime, optional): inclusive start of the range. Defaults to None.
+            end (datetime, optional): exclusive end of the range. Defaults to None.
+
+        Returns:
+            list: names of the collections to query, sorted by time
+        """
+        partitions = self.get_partitions(collection_name)
+        if len(partitions) == 0:
+            return [collection_name]
+        return [
+            name
+            for name, (partition_start, partition_end) in partitions.items()
+            if (start is None or partition_end > start)
+            and (end is None or partition_start < end)
+        ]
+
+    def find_partitioned(
+        self,
+        collection_name,
+        query={},
+        fields={},
+        start=None,
+        end=None,
+        key="date_time",
+        read_preference=None,
+    ):
+        """Find documents in the time partitions of a collection overlapping a time range.
+        The partitions are read one after the other, oldest first.
+
+        Args:
+            collection_name (str): Name of the partitioned collection
+            query (dict, optional): the filter. Defaults to {}.
+            fields (dict, optional): the projection. Defaults to {}.
+            start (datetime, optional): inclusive start of the range. Defaults to None.
+            end (datetime, optional): exclusive end of the range. Defaults to None.
+            key (str, optional): the time field of the partitions. Defaults to "date_time".
+            read_preference (ReadPreference, optional): where to read. Defaults to None (primary).
+
+        Yields:
+            dict: the documents
+        """
+        query = self._with_time_range(query, start, end, key)
+        for name in self.prune_partitions(collection_name, start, end):
+            yield from self.find_documents(name, query, fields, read_preference)
+
+    def aggregate_partitioned(
+        self,
+        collection_name,
+        pipeline: list,
+        start=None,
+        end=None,
+        key="date_time",
+        read_preference=None,
+    ):
+        """Perform an aggregation over the time partitions of a collection overlapping
+        a time range, combined with $unionWith.
+        The leading $match stages are applied to every partition before the union.
+
+        Args:
+            collection_name (str): Name of the partitioned collection
+            pipeline (list): Stages in the aggregation
+            start (datetime, optional): inclusive start of the range. Defaults to None.
+            end (datetime, optional): exclusive end of the range. Defaults to None.
+            key (str, optional): the time field of the partitions. Defaults to "date_time".
+            read_preference (ReadPreference, optional): where to read. Defaults to None (primary).
+
+        Returns:
+            ~pymongo.command_cursor.CommandCursor: The results of the aggregation.
+        """
+        names = self.prune_partitions(collection_name, start, end)
+        if len(names) == 0:
+            return iter([])
+
+        # Push the filters down into every partition
+        nr_matches = 0
+        while nr_matches < len(pipeline) and "$match" in pipeline[nr_matches]:
+            nr_matches += 1
+        pushdown = pipeline[:nr_matches]
+        time_range = self._with_time_range({}, start, end, key)
+        if time_range:
+            pushdown = [{"$match": time_range}] + pushdown
+
+        union = [{"$unionWith": {"coll": name, "pipeline": pushdown}} for name in names[1:]]
+        return self.aggregate(
+            names[0], pushdown + union + pipeline[nr_matches:], read_preference
+        )
+
+    def drop_partitions(self, collection_name, before) -> list:
+        """Drop the time partitions of a collection that end before a time
+
+        Args:
+            collection_name (str): Name of the partitioned collection
+            before (datetime): drop partitions with only documents before this time
+
+        Returns:
+            list: names of the dropped partitions
+        """
+        dropped = []
+        for name, (_, end) in self.get_partitions(collection_name).items():
+            if end <= before:
+                self.drop_coll(name)
+                dropped.append(name)
+        return dropped
+
+    @staticmethod
+    def _with_time_range(query, start, end, key) -> dict:
+        """Add a time range to a query
+
+        Args:
+            query (dict): the filter
+            start (datetime | None): inclusive start of the range
+            end (datetime | None): exclusive end of the range
+            key (str): the time field
+
+        Returns:
+            dict: the filter including the time range
+        """
+        time_range = {}
+        if start is not None:
+            time_range["$gte"] = start
+        if end is not None:
+            time_range["$lt"] = end
+        if not time_range:
+            return query
+        return {"$and": [query, {key: time_range}]} if query else {key: time_range}
+
+    def explain_find(
+        self, collection_name, query={}, fields={}, read_preference=None
+    ) -> dict:
+        """Explain a find query with executionStats verbosity.
+        The query is executed, but no documents are returned.
+
+        Args:
+            collection_name (str): Name of the collection
+            query (dict, optional): the filter. Defaults to {}.
+            fields (dict, optional): the projection. Defaults to {}.
+            read_preference (ReadPreference, optional): where the query is explained,
+                as where it is executed. Defaults to None (primary).
+
+        Returns:
+            dict: the explain output
+        """
+        command = {"find": collection_name, "filter": query}
+        if fields:
+            command["projection"] = fields
+        return self._explain(collection_name, command, read_preference)
+
+    def explain_aggregate(
+        self, collection_name, pipeline: list, read_preference=None
+    ) -> dict:
+        """Explain an aggregation with executionStats verbosity.
+        The aggregation is executed, but no documents are returned.
+
+        Args:
+            collection_name (str): Name of the collection
+            pipeline (list): Stages in the aggregation
+            read_preference (ReadPreference, optional): where the aggregation is explained,
+                as where it is executed. Defaults to None (primary).
+
+        Returns:
+            dict: the explain output
+        """
+        command = {"aggregate": collection_name, "pipeline": pipeline, "cursor": {}}
+        return self._explain(collection_name, command, read_preference)
+
+    def _explain(self, collection_name, command, read_preference) -> dict:
+        """Explain a command on the server selected by the read preference
+
+        Args:
+            collection_name (str): Name of the collection
+            command (dict): the find or aggregate command
+            read_preference (ReadPreference | None): where to explain
+
+        Returns:
+            dict: the explain output
+        """
+        collection = self.get_collection(collection_name, read_preference)
+        return collection.database.command(
+            {"explain": command, "verbosity": "executionStats"},
+            read_preference=collection.read_preference,
+        )
+
     def drop_coll(self, collection_name):
         """Remove a collection from the database
 
@@ -144,3 +738,40 @@ class DbHandler:
             list: All collections for the db
         """
         return self.db.list_collection_names()
+
+
+def _scan_partition(
+    connection_args, collection_names, query, fields, sort, mapper, read_preference
+):
+    """Scan one partition of a collection in a worker process
+
+    Args:
+        connection_args (tuple): (uri, database) of the connection of the handler
+        collection_names (list): Names of the collection or its time partitions, oldest first
+        query (dict): the filter, including the range of the partition
+        fields (dict): the projection
+        sort (list | None): (field, direction) pairs, applied within each collection
+        mapper (Callable): documents -> partial aggregate
+        read_preference (ReadPreference | None): where to read
+
+    Returns:
+        The partial aggregate
+    """
+
+    def documents():
+        for name in collection_names:
+            collection = connection.db[name]
+            if read_preference is not None:
+                collection = collection.with_options(read_preference=read_preference)
+            cursor = collection.find(query, fields or None)
+            if sort is not None:
+                cursor = cursor.sort(sort)
+            yield from cursor
+
+    # A MongoClient can not be shared across processes
+    uri, database = connection_args
+    connection = DbConnector(DATABASE=database, URI=uri)
+    try:
+        return mapper(documents())
+    finally:
+        connection.close_connection()
@@ -0,0 +1,150 @@
+"""Opt-in profiling of the ingest stages and the part 2 tasks.
+
+Code is wrapped in named stages:
+    with profiler.stage("read"):
+        data = read_data_file(path)
+
+When the profiler is disabled (the default) a stage does nothing.
+When enabled, the time, peak and retained memory (tracemalloc) is recorded per stage,
+and optionally the call stacks are sampled and written in the folded format
+that is used by flamegraph.pl and speedscope.
+"""
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Profiler:
+    """Records time, memory and sampled call stacks per stage"""
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}  # stage path -> {"calls", "time", "peak", "retained"}
+        self.samples = Counter()  # folded stack -> number of samples
+        self.stacks = {}  # thread id -> list of open stages
+        self.sampler = None
+        self.stop_sampling = threading.Event()
+
+    def enable(self, sample_interval=None):
+        """Start profiling
+
+        Args:
+            sample_interval (float, optional): seconds between call stack samples.
+                Defaults to None (no sampling).
+        """
+        self.enabled = True
+        tracemalloc.start()
+        if sample_interval is not None:
+            self.stop_sampling.clear()
+            self.sampler = threading.Thread(
+                target=self._sample, args=(sample_interval,), daemon=True
+            )
+            self.sampler.start()
+
+    def disable(self):
+        """Stop profiling. The recorded stats are kept"""
+        self.enabled = False
+        if self.sampler is not None:
+            self.stop_sampling.set()
+            self.sampler.join()
+            self.sampler = None
+        tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        """Record the code in the with-block as a stage.
+        Stages can be nested, and are then recorded as "outer;inner".
+
+        Args:
+            name (str): name of the stage
+        """
+        if not self.enabled:
+            yield
+            return
+
+        stack = self.stacks.setdefault(threading.get_ident(), [])
+        current, peak_before = tracemalloc.get_traced_memory()
+        if stack:
+            # The outer stage must not lose its peak when it is reset
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak_before)
+        tracemalloc.reset_peak()
+        frame = {"name": name, "start": current, "peak": 0}
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            path = ";".join(open_stage["name"] for open_stage in stack)
+            stack.pop()
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+
+            stats = self.stats.setdefault(
+                path, {"calls": 0, "time": 0.0, "peak": 0, "retained": 0}
+            )
+            stats["calls"] += 1
+            stats["time"] += elapsed
+            stats["peak"] = max(stats["peak"], max(peak, frame["peak"]) - frame["start"])
+            stats["retained"] += current - frame["start"]
+
+    def _sample(self, interval):
+        """Sample the call stacks of the threads inside a stage, runs in a separate thread
+
+        Args:
+            interval (float): seconds between samples
+        """
+        while not self.stop_sampling.wait(interval):
+            frames = sys._current_frames()
+            for thread_id, stack in list(self.stacks.items()):
+                frame = frames.get(thread_id)
+                if not stack or frame is None:
+                    continue
+
+                # Outermost call first
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stages = [open_stage["name"] for open_stage in stack]
+                self.samples[";".join(stages + calls[::-1])] += 1
+
+    def write_folded(self, path):
+        """Write the sampled call stacks in the folded format, one stack per line
+
+        Args:
+            path (str): path to the output file
+        """
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in sorted(self.samples.items()):
+                file.write(f"{stack} {count}\n")
+
+    def report(self) -> str:
+        """Tabulate the recorded stats
+
+        Returns:
+            str: tabulated stats
+        """
+        from tabulate import tabulate
+
+        rows = [
+            [
+                path,
+                stats["calls"],
+                stats["time"],
+                stats["peak"] / 2**20,
+                stats["retained"] / 2**20,
+            ]
+            for path, stats in sorted(self.stats.items())
+        ]
+        headers = ["Stage", "Calls", "Time (s)", "Peak (MiB)", "Retained (MiB)"]
+        return tabulate(rows, headers=headers, floatfmt=".3f")
+
+
+# The profiler used by the ingest and the part 2 tasks
+profiler = Profiler()
@@ -0,0 +1,101 @@
+"""Route signatures of activities, used to find activities following the same route.
+
+The route of an activity is the set of grid cells it visits.
+The signature is a MinHash of this set: the fraction of equal MinHash values
+of two activities estimates the Jaccard similarity of their routes.
+The signature is split into bands that are stored in the RouteSignature collection,
+with a multikey index. Activities sharing at least one band are candidates,
+found by an index lookup instead of comparing with every activity (locality-sensitive hashing).
+"""
+from Sketches import stable_hash
+
+GRID_SIZE = 0.005  # degrees, ~500 m
+NUM_HASHES = 64
+NUM_BANDS = 16  # 4 rows per band, candidates are likely from ~50% similarity
+PRIME = (1 << 61) - 1
+
+# Coefficients of the hash functions h(x) = (a * x + b) mod PRIME
+_COEFFICIENTS = [
+    (stable_hash(i, 1) % (PRIME - 1) + 1, stable_hash(i, 2) % PRIME)
+    for i in range(NUM_HASHES)
+]
+
+
+def grid_cells(trackpoints: list) -> set:
+    """The grid cells visited by an activity
+
+    Args:
+        trackpoints (list[dict]): trackpoints with lat and lon
+
+    Returns:
+        set: the cells, e.g. "7983,23279"
+    """
+    return {
+        f"{int(tp['lat'] // GRID_SIZE)},{int(tp['lon'] // GRID_SIZE)}"
+        for tp in trackpoints
+    }
+
+
+def minhash(cells: set) -> list:
+    """The MinHash signature of a set of cells
+
+    Args:
+        cells (set): the visited cells
+
+    Returns:
+        list: NUM_HASHES minimum hash values
+    """
+    hashed = [stable_hash(cell) % PRIME for cell in cells]
+    return [min((a * x + b) % PRIME for x in hashed) for a, b in _COEFFICIENTS]
+
+
+def lsh_bands(signature: list) -> list:
+    """Split a signature into bands, two signatures with an equal band are candidates
+
+    Args:
+        signature (list): the MinHash signature
+
+    Returns:
+        list: the bands, e.g. "3:9f2c1a0b4d5e6f70"
+    """
+    rows = len(signature) // NUM_BANDS
+    return [
+        f"{band}:{stable_hash(signature[band * rows : (band + 1) * rows]):016x}"
+        for band in range(NUM_BANDS)
+    ]
+
+
+def similarity(a: list, b: list) -> float:
+    """Estimate the Jaccard similarity of two routes from their signatures
+
+    Args:
+        a (list): MinHash signature
+        b (list): MinHash signature
+
+    Returns:
+        float: similarity between 0 and 1
+    """
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def insert_signature(db, activity_id, user_id, trackpoints: list):
+    """Compute and insert the route signature of an activity
+
+    Args:
+        db (DbHandler): The database
+        activity_id (ObjectID): id of the activity
+        user_id (str): id of the user
+        trackpoints (list[dict]): the trackpoints of the activity
+    """
+    signature = minhash(grid_cells(trackpoints))
+    db.insert_documents(
+        "RouteSignature",
+        [
+            {
+                "_id": activity_id,
+                "user_id": user_id,
+                "minhash": signature,
+                "bands": lsh_bands(signature),
+            }
+        ],
+    )
@@ -0,0 +1,225 @@
+"""Sketches maintained at ingest, used by the approximate part 2 queries.
+
+- RegionSketch: a HyperLogLog of the users per region (lat/lon rounded to 3 decimals, as in task 10).
+  The registers are stored sparse as {"registers": {"<index>": rank}} and updated with $max,
+  so updates are idempotent and can be done in any order.
+- Sketch "altitude_gain": a count-min sketch of the gained altitude per user (task 8),
+  stored as {"table": {"<row>": {"<column>": count}}, "total": count} and updated with $inc.
+  The gain of every activity is stored in "contributions" in the same update, so an activity
+  is counted at most once, and can be removed again when its insertion is undone.
+  The HyperLogLog can not be undone, but the registers of a user that is inserted again are equal.
+"""
+import hashlib
+from math import e, log, sqrt
+from pymongo.errors import DuplicateKeyError
+
+HLL_PRECISION = 10  # 2**10 registers, standard error 1.04 / sqrt(1024) = 3.25%
+CM_WIDTH = 2048  # error <= e / width * total
+CM_DEPTH = 5  # with probability 1 - e**-depth
+
+
+def stable_hash(value, seed=0) -> int:
+    """A 64 bit hash that is stable across processes and machines
+
+    Args:
+        value (str): value to hash
+        seed (int, optional): select an independent hash function. Defaults to 0.
+
+    Returns:
+        int: the hash
+    """
+    digest = hashlib.blake2b(
+        str(value).encode("utf-8"), digest_size=8, salt=seed.to_bytes(8, "little")
+    ).digest()
+    return int.from_bytes(digest, "little")
+
+
+def region_key(lat, lon) -> str:
+    """The region of a coordinate, rounded to 3 decimals (~100 m)
+
+    Args:
+        lat (float): latitude
+        lon (float): longitude
+
+    Returns:
+        str: the region, e.g. "39.916,116.397"
+    """
+    return f"{round(lat, 3):.3f},{round(lon, 3):.3f}"
+
+
+def hll_register(value, precision=HLL_PRECISION) -> tuple:
+    """The HyperLogLog register a value updates
+
+    Args:
+        value (str): the value, e.g. a user id
+        precision (int, optional): log2 of the number of registers. Defaults to HLL_PRECISION.
+
+    Returns:
+        tuple: (index of the register, rank)
+    """
+    hashed = stable_hash(value)
+    index = hashed >> (64 - precision)
+    rest = hashed & ((1 << (64 - precision)) - 1)
+    # Position of the leftmost 1-bit in the remaining bits
+    rank = (64 - precision) - rest.bit_length() + 1
+    return index, rank
+
+
+def hll_estimate(registers: dict, precision=HLL_PRECISION) -> tuple:
+    """Estimate the number of distinct values from the registers
+
+    Args:
+        registers (dict): "<index>" -> rank, missing registers are 0
+        precision (int, optional): log2 of the number of registers. Defaults to HLL_PRECISION.
+
+    Returns:
+        tuple: (estimate, standard error)
+    """
+    m = 1 << precision
+    alpha = 0.7213 / (1 + 1.079 / m)
+    zeros = m - len(registers)
+    estimate = alpha * m * m / (zeros + sum(2.0 ** -rank for rank in registers.values()))
+
+    # Small range correction, linear counting
+    if estimate <= 2.5 * m and zeros > 0:
+        estimate = m * log(m / zeros)
+    return estimate, 1.04 / sqrt(m) * estimate
+
+
+def cm_cells(key, depth=CM_DEPTH, width=CM_WIDTH) -> list:
+    """The count-min cells a key is counted in, one per row
+
+    Args:
+        key (str): the key, e.g. a user id
+        depth (int, optional): number of rows. Defaults to CM_DEPTH.
+        width (int, optional): number of columns. Defaults to CM_WIDTH.
+
+    Returns:
+        list: (row, column) pairs
+    """
+    return [(row, stable_hash(key, row + 1) % width) for row in range(depth)]
+
+
+def cm_estimate(table: dict, key, depth=CM_DEPTH, width=CM_WIDTH) -> int:
+    """Estimate the count of a key. Never below the true count.
+
+    Args:
+        table (dict): "<row>" -> {"<column>": count}
+        key (str): the key
+        depth (int, optional): number of rows. Defaults to CM_DEPTH.
+        width (int, optional): number of columns. Defaults to CM_WIDTH.
+
+    Returns:
+        int: the estimated count
+    """
+    return min(
+        table.get(str(row), {}).get(str(column), 0)
+        for row, column in cm_cells(key, depth, width)
+    )
+
+
+def cm_error_bound(total, depth=CM_DEPTH, width=CM_WIDTH) -> tuple:
+    """The overestimate of a count-min estimate is at most the bound, with a probability
+
+    Args:
+        total (int): sum of all counts
+        depth (int, optional): number of rows. Defaults to CM_DEPTH.
+        width (int, optional): number of columns. Defaults to CM_WIDTH.
+
+    Returns:
+        tuple: (bound, probability)
+    """
+    return e / width * total, 1 - e**-depth
+
+
+def update_sketches(db, user_id, trackpoints: list):
+    """Add an activity to the sketches
+
+    Args:
+        db (DbHandler): The database
+        user_id (str): Id of the user
+        trackpoints (list[dict]): the trackpoints of the activity, in order
+    """
+    from part2 import gained_altitude
+
+    # Distinct users per region
+    index, rank = hll_register(user_id)
+    regions = {region_key(tp["lat"], tp["lon"]) for tp in trackpoints}
+    db.bulk_update(
+        "RegionSketch",
+        [
+            ({"_id": region}, {"$max": {f"registers.{index}": rank}})
+            for region in regions
+        ],
+        upsert=True,
+    )
+
+    # Gained altitude per user, once per activity
+    gain = gained_altitude(trackpoints).get(user_id, 0)
+    if gain == 0:
+        return
+    activity_id = trackpoints[0]["activity_id"]
+    try:
+        db.update_documents(
+            "Sketch",
+            {"_id": "altitude_gain"},
+            {"$setOnInsert": {"table": {}, "total": 0, "contributions": {}}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        pass  # Created by a concurrent upsert
+    db.update_documents(
+        "Sketch",
+        {"_id": "altitude_gain", f"contributions.{activity_id}": {"$exists": False}},
+        {
+            "$inc": _cm_increments(user_id, gain),
+            "$set": {
+                f"contributions.{activity_id}": {"user_id": user_id, "gain": gain}
+            },
+        },
+    )
+
+
+def remove_from_sketches(db, user_id, activity_ids=None, keep=()):
+    """Undo the count-min updates of the activities of a user
+
+    Args:
+        db (DbHandler): The database
+        user_id (str): Id of the user
+        activity_ids (list, optional): the activities to remove. Defaults to None (all).
+        keep (list, optional): the activities to keep. Defaults to ().
+    """
+    sketch = list(
+        db.find_documents("Sketch", {"_id": "altitude_gain"}, {"contributions": 1})
+    )
+    if len(sketch) == 0:
+        return
+    remove = None if activity_ids is None else {str(aid) for aid in activity_ids}
+    keep = {str(aid) for aid in keep}
+
+    for activity_id, contribution in sketch[0].get("contributions", {}).items():
+        if contribution["user_id"] != user_id or activity_id in keep:
+            continue
+        if remove is not None and activity_id not in remove:
+            continue
+        increments = _cm_increments(user_id, -contribution["gain"])
+        db.update_documents(
+            "Sketch",
+            {"_id": "altitude_gain", f"contributions.{activity_id}": {"$exists": True}},
+            {"$inc": increments, "$unset": {f"contributions.{activity_id}": ""}},
+        )
+
+
+def _cm_increments(user_id, gain) -> dict:
+    """The $inc of the count-min cells of a user, and of the total
+
+    Args:
+        user_id (str): Id of the user
+        gain (int): the gained altitude, negative to remove it
+
+    Returns:
+        dict: field -> increment
+    """
+    increments = {f"table.{row}.{column}": gain for row, column in cm_cells(user_id)}
+    increments["total"] = gain
+    return increments
@@ -0,0 +1,160 @@
+"""Simplification of trajectories before they are inserted into the database.
+
+Every simplifier takes the data lines of a .plt file (as returned by read_data_file)
+and returns the subset of lines that should be kept.
+The first and the last line are always kept, so the start and end time of the activity is preserved.
+Format of a line: [lat, lon, 0, altitude, date_days, date, time]
+"""
+from functools import partial
+from math import cos, hypot, radians
+
+EARTH_RADIUS = 6371000  # meters
+METHODS = ("douglas_peucker", "decimate")
+
+
+def douglas_peucker(data, tolerance=10.0, max_seconds=60.0) -> "list[list]":
+    """Simplify a trajectory with the Douglas-Peucker algorithm.
+    Points that are closer than the tolerance to the simplified line are removed,
+    unless the time between the kept points would exceed max_seconds.
+    Gaps between kept points are then only longer than max_seconds where the original
+    trajectory has such a gap, so the invalid activities of task 9 are preserved.
+
+    Args:
+        data (list[list]): the trackpoints of the activity
+        tolerance (float, optional): max deviation in meters. Defaults to 10.0.
+        max_seconds (float, optional): max time between kept points,
+            unless consecutive in the original trajectory. Defaults to 60.0.
+
+    Returns:
+        list[list]: the trackpoints that are kept
+    """
+    if len(data) < 3:
+        return data
+
+    points = _project(data)
+    seconds = [float(line[4]) * 86400 for line in data]  # days -> seconds
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+
+    # Iterative to avoid the recursion limit on long trajectories
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        max_distance, index = 0.0, -1
+        for i in range(start + 1, end):
+            distance = _segment_distance(points[i], points[start], points[end])
+            if distance > max_distance:
+                max_distance, index = distance, i
+
+        # Split on the point furthest away from the line,
+        # or in the middle if the points are too far apart in time
+        if max_distance > tolerance:
+            split = index
+        elif seconds[end] - seconds[start] > max_seconds and end - start > 1:
+            split = (start + end) // 2
+        else:
+            continue
+        keep[split] = True
+        stack.append((start, split))
+        stack.append((split, end))
+
+    return [line for line, kept in zip(data, keep) if kept]
+
+
+def decimate(data, min_seconds=10.0, min_meters=20.0) -> "list[list]":
+    """Simplify a trajectory by dropping points that are both too close in time
+    and too close in distance to the previous kept point.
+
+    Args:
+        data (list[list]): the trackpoints of the activity
+        min_seconds (float, optional): min time between kept points. Defaults to 10.0.
+        min_meters (float, optional): min distance between kept points. Defaults to 20.0.
+
+    Returns:
+        list[list]: the trackpoints that are kept
+    """
+    if len(data) < 3:
+        return data
+
+    points = _project(data)
+    kept = [data[0]]
+    last = 0
+    for i in range(1, len(data) - 1):
+        seconds = (float(data[i][4]) - float(data[last][4])) * 86400  # days -> seconds
+        meters = hypot(points[i][0] - points[last][0], points[i][1] - points[last][1])
+        if seconds >= min_seconds or meters >= min_meters:
+            kept.append(data[i])
+            last = i
+    kept.append(data[-1])
+    return kept
+
+
+def get_simplifier(
+    method="douglas_peucker", tolerance=10.0, min_seconds=10.0, max_seconds=60.0
+):
+    """Get a configured simplifier
+
+    Args:
+        method (str, optional): "douglas_peucker" or "decimate". Defaults to "douglas_peucker".
+        tolerance (float, optional): max deviation (douglas_peucker) or
+            min distance between kept points (decimate) in meters, 0 to disable. Defaults to 10.0.
+        min_seconds (float, optional): min time between kept points (decimate). Defaults to 10.0.
+        max_seconds (float, optional): max time between kept points (douglas_peucker).
+            Defaults to 60.0.
+
+    Raises:
+        ValueError: If the method is unknown
+
+    Returns:
+        Callable | None: the simplifier, None if disabled
+    """
+    if tolerance <= 0:
+        return None
+    if method == "douglas_peucker":
+        return partial(douglas_peucker, tolerance=tolerance, max_seconds=max_seconds)
+    if method == "decimate":
+        return partial(decimate, min_seconds=min_seconds, min_meters=tolerance)
+    raise ValueError(f"Unknown simplification method {method}, expected one of {METHODS}")
+
+
+def _project(data) -> "list[tuple]":
+    """Project the lat/lon of the trackpoints to meters on a local plane (equirectangular),
+    with the first trackpoint as origin. Accurate enough for the extent of one activity.
+
+    Args:
+        data (list[list]): the trackpoints of the activity
+
+    Returns:
+        list[tuple]: (x, y) in meters
+    """
+    lat0, lon0 = float(data[0][0]), float(data[0][1])
+    scale = cos(radians(lat0))
+    return [
+        (
+            EARTH_RADIUS * radians(float(line[1]) - lon0) * scale,
+            EARTH_RADIUS * radians(float(line[0]) - lat0),
+        )
+        for line in data
+    ]
+
+
+def _segment_distance(point, start, end) -> float:
+    """Distance from a point to the line segment between start and end
+
+    Args:
+        point (tuple): (x, y)
+        start (tuple): (x, y)
+        end (tuple): (x, y)
+
+    Returns:
+        float: the distance
+    """
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length = dx * dx + dy * dy
+    if length == 0:
+        return hypot(point[0] - start[0], point[1] - start[1])
+
+    # Closest point on the segment
+    t = ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / length
+    t = max(0.0, min(1.0, t))
+    return hypot(point[0] - start[0] - t * dx, point[1] - start[1] - t * dy)
@@ -0,0 +1,275 @@
+"""Command-line entry point for the assignment.
+
+Subcommands:
+    ingest   Clear the database and insert the dataset (part 1)
+    query    Run part 2 tasks, e.g. `query --task 7 --task 10`
+    bench    Time part 2 tasks over several runs
+    indexes  Create the indexes
+    watch    Insert new trajectory files as they arrive
+    similar  Find activities following the same route as an activity
+    drop-partitions  Drop the trackpoint partitions before a date
+
+Heavy dependencies are imported by the subcommand that needs them,
+so running a single task starts fast. Use --json for machine-readable output.
+Use --profile to report time and memory per ingest stage and task,
+and --profile-stacks to also write sampled call stacks for a flamegraph.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+
+def ingest(db, args) -> dict:
+    """Clear the database and insert the dataset"""
+    from decouple import config
+    from part1 import get_ingest_options, load_dataset
+    from TrajectorySimplifier import get_simplifier
+
+    options = get_ingest_options()
+    if args.simplify_tolerance is not None or args.simplify_method is not None:
+        options.simplifier = get_simplifier(
+            args.simplify_method
+            or config("SIMPLIFY_METHOD", default="douglas_peucker", cast=str),
+            args.simplify_tolerance
+            if args.simplify_tolerance is not None
+            else config("SIMPLIFY_TOLERANCE", default=0, cast=float),
+            config("SIMPLIFY_MIN_SECONDS", default=10, cast=float),
+            config("SIMPLIFY_MAX_SECONDS", default=60, cast=float),
+        )
+
+    if args.sketches:
+        options.sketches = True
+    if args.signatures:
+        options.signatures = True
+    if args.partition_by is not None:
+        options.partition_by = args.partition_by
+
+    start = time.time()
+    load_dataset(db, options, args.stop_at_user)
+    return {"time": time.time() - start}
+
+
+def query(db, args) -> dict:
+    """Run the selected part 2 tasks, and return their results"""
+    import part2
+
+    from Profiler import profiler
+
+    tasks = dict(part2.TASKS)
+    if args.approximate:
+        import part2_approximate
+
+        tasks.update(part2_approximate.TASKS)
+
+    results = {}
+    for nr in args.task or tasks:
+        exact = tasks[nr] is part2.TASKS[nr]
+        kwargs = {"partitions": args.partitions} if nr in (8, 9) and exact else {}
+        with profiler.stage(f"task_{nr}"):
+            results[f"task_{nr}"] = tasks[nr](db, **kwargs)
+    return results
+
+
+def bench(db, args) -> dict:
+    """Time the selected part 2 tasks"""
+    import part2
+
+    results = {}
+    for nr in args.task or part2.TASKS:
+        kwargs = {"partitions": args.partitions} if nr in (8, 9) else {}
+        times = []
+        for _ in range(args.repeat):
+            start = time.time()
+            # Only the time is of interest
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                part2.TASKS[nr](db, **kwargs)
+            times.append(time.time() - start)
+        results[f"task_{nr}"] = {
+            "min": min(times),
+            "mean": sum(times) / len(times),
+            "max": max(times),
+        }
+        if not args.json:
+            print(
+                f"task_{nr}: min {min(times):.3f}s, "
+                f"mean {sum(times) / len(times):.3f}s, max {max(times):.3f}s"
+            )
+    return results
+
+
+def indexes(db, args) -> dict:
+    """Create the indexes"""
+    from part1 import create_indexes
+
+    start = time.time()
+    create_indexes(db)
+    return {"time": time.time() - start}
+
+
+def watch(db, args) -> dict:
+    """Insert new trajectory files as they arrive"""
+    from part1 import get_ingest_options
+    from ingest_watcher import TrajectoryWatcher
+
+    watcher = TrajectoryWatcher(db, options=get_ingest_options())
+    watcher.skip_existing()
+    watcher.watch(args.interval)
+    return {"latencies": watcher.latencies}
+
+
+def similar(db, args) -> list:
+    """Find activities following the same route as an activity"""
+    from bson import ObjectId
+
+    activities = db.find_similar_activities(ObjectId(args.activity), args.k)
+    if not args.json:
+        for activity in activities:
+            print(
+                f"{activity['_id']} (user {activity['user_id']}): "
+                f"{activity['similarity']:.2f}"
+            )
+    return activities
+
+
+def drop_partitions(db, args) -> list:
+    """Drop the trackpoint partitions before a date"""
+    from datetime import datetime
+
+    dropped = db.drop_partitions("TrackPoint", datetime.fromisoformat(args.before))
+    if not args.json:
+        print(f"Dropped {dropped}")
+    return dropped
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Build the argument parser
+
+    Returns:
+        argparse.ArgumentParser: the parser
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--json", action="store_true", help="print the results as json"
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="report time and memory per stage"
+    )
+    parser.add_argument(
+        "--profile-stacks", help="write sampled call stacks to this file (folded format)"
+    )
+    parser.add_argument(
+        "--sample-interval", type=float, default=0.005, help="seconds between samples"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_ingest = subparsers.add_parser("ingest", help=ingest.__doc__)
+    parser_ingest.add_argument("--stop-at-user", default="")
+    parser_ingest.add_argument(
+        "--simplify-method",
+        choices=["douglas_peucker", "decimate"],
+        help="simplification of the trajectories",
+    )
+    parser_ingest.add_argument(
+        "--simplify-tolerance",
+        type=float,
+        help="max deviation (douglas_peucker) or min distance (decimate) in meters, 0 to disable",
+    )
+    parser_ingest.add_argument(
+        "--sketches",
+        action="store_true",
+        help="maintain the sketches of the approximate queries",
+    )
+    parser_ingest.add_argument(
+        "--signatures",
+        action="store_true",
+        help="insert the route signatures of the similarity search",
+    )
+    parser_ingest.add_argument(
+        "--partition-by",
+        choices=["year", "month"],
+        help="insert the trackpoints into one collection per year or month",
+    )
+    parser_ingest.set_defaults(func=ingest)
+
+    for name, func in (("query", query), ("bench", bench)):
+        parser_tasks = subparsers.add_parser(name, help=func.__doc__)
+        parser_tasks.add_argument(
+            "--task",
+            type=int,
+            action="append",
+            choices=range(1, 12),
+            help="task to run, can be repeated. Defaults to all",
+        )
+        parser_tasks.add_argument(
+            "--partitions",
+            type=int,
+            help="scan the trackpoints of task 8 and 9 in parallel",
+        )
+        parser_tasks.set_defaults(func=func)
+    subparsers.choices["query"].add_argument(
+        "--approximate",
+        action="store_true",
+        help="estimate task 8, 9 and 10 with sketches and sampling",
+    )
+    subparsers.choices["bench"].add_argument("--repeat", type=int, default=3)
+
+    parser_indexes = subparsers.add_parser("indexes", help=indexes.__doc__)
+    parser_indexes.set_defaults(func=indexes)
+
+    parser_watch = subparsers.add_parser("watch", help=watch.__doc__)
+    parser_watch.add_argument(
+        "--interval", type=float, default=1.0, help="seconds between polls"
+    )
+    parser_watch.set_defaults(func=watch)
+
+    parser_similar = subparsers.add_parser("similar", help=similar.__doc__)
+    parser_similar.add_argument("--activity", required=True, help="id of the activity")
+    parser_similar.add_argument("--k", type=int, default=10)
+    parser_similar.set_defaults(func=similar)
+
+    parser_drop = subparsers.add_parser("drop-partitions", help=drop_partitions.__doc__)
+    parser_drop.add_argument("--before", required=True, help="date, e.g. 2009-01-01")
+    parser_drop.set_defaults(func=drop_partitions)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = get_parser().parse_args(argv)
+
+    from DbHandler import DbHandler
+    from Profiler import profiler
+
+    if args.profile or args.profile_stacks:
+        profiler.enable(args.sample_interval if args.profile_stacks else None)
+
+    db = None
+    try:
+        # Keep stdout clean for the json output
+        with contextlib.redirect_stdout(sys.stderr if args.json else sys.stdout):
+            db = DbHandler()
+            results = args.func(db, args)
+    except Exception as e:
+        print("ERROR: Failed to use database:", e, file=sys.stderr)
+        return 1
+    finally:
+        if db:
+            with contextlib.redirect_stdout(sys.stderr if args.json else sys.stdout):
+                db.connection.close_connection()
+
+    if profiler.enabled:
+        profiler.disable()
+        print(profiler.report(), file=sys.stderr)
+        if args.profile_stacks:
+            profiler.write_folded(args.profile_stacks)
+
+    if args.json:
+        # ObjectId and datetime are not json serializable
+        print(json.dumps(results, default=str, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
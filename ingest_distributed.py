@@ -0,0 +1,336 @@
+"""Distributed ingest of the dataset, coordinated through a lease collection.
+
+Any number of workers, on one or several machines, claim user directories
+from a shared work queue (the IngestLease collection). A claimed user is leased
+for a period, and the lease is renewed while the worker is inserting the user.
+A worker stops writing when a renewal fails, or when the lease may have expired
+since the last successful renewal.
+If a worker dies the lease expires, and the user is claimed by another worker,
+which first removes what was partially inserted.
+The user document is only written by the worker that completes the lease, and the activities
+of the user that are not in the completed user document (written by a worker that lost its lease)
+are removed. Every user is therefore inserted exactly once.
+All lease times are taken from the server clock ($$NOW), so the machines do not need synchronized clocks.
+
+The indexes are not created by the workers, run `python cli.py indexes` when all users are done.
+
+Usage:
+    python ingest_distributed.py --reset            # clear the database and the queue, run once
+    python ingest_distributed.py --processes 4      # start 4 workers on this machine
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+import uuid
+from multiprocessing import Process
+from DbHandler import DbHandler
+from FileHandler import read_labeled_users_file
+from part1 import get_ingest_options, insert_user
+from Sketches import remove_from_sketches
+
+LEASE_COLLECTION = "IngestLease"
+
+
+class LeaseWorker:
+    """A worker that claims users from the queue and inserts them"""
+
+    def __init__(
+        self, db: DbHandler, path_to_dataset="./dataset", lease_seconds=60, options=None
+    ):
+        self.db = db
+        self.path_to_dataset = path_to_dataset
+        self.lease_ms = int(lease_seconds * 1000)
+        self.options = options
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_lost = threading.Event()
+        self.lease_deadline = 0.0  # local time the lease may expire, time.monotonic()
+        self.lost = set()  # users this worker lost the lease of
+
+    def seed_queue(self):
+        """Add every user in the dataset to the queue. Users already in the queue are kept.
+        Only directories with trajectories are users, other entries (e.g. .DS_Store) are skipped.
+        """
+        path_to_data = os.path.join(self.path_to_dataset, "Data")
+        for user in os.listdir(path_to_data):
+            if not os.path.isdir(os.path.join(path_to_data, user, "Trajectory")):
+                continue
+            self.db.update_documents(
+                LEASE_COLLECTION,
+                {"_id": user},
+                {
+                    "$setOnInsert": {
+                        "state": "pending",
+                        "owner": None,
+                        "lease_expires": None,
+                        "attempts": 0,
+                    }
+                },
+                upsert=True,
+            )
+
+    def claim(self):
+        """Claim a pending user, or a user with an expired lease
+
+        Returns:
+            dict | None: the lease, None if no user could be claimed
+        """
+        # The server sets the expiry after the request is sent
+        deadline = time.monotonic() + self.lease_ms / 1000
+        query = {
+            "$or": [
+                {"state": "pending"},
+                {"state": "leased", "$expr": {"$lt": ["$lease_expires", "$$NOW"]}},
+            ]
+        }
+        update = [
+            {
+                "$set": {
+                    "state": "leased",
+                    "owner": self.worker_id,
+                    "lease_expires": {"$add": ["$$NOW", self.lease_ms]},
+                    "attempts": {"$add": ["$attempts", 1]},
+                }
+            }
+        ]
+        lease = self.db.find_and_update(LEASE_COLLECTION, query, update)
+        self.lease_deadline = deadline
+        return lease
+
+    def renew(self, user) -> bool:
+        """Extend the lease of a user
+
+        Args:
+            user (str): id of the user
+
+        Returns:
+            bool: False if the lease is no longer owned by this worker
+        """
+        deadline = time.monotonic() + self.lease_ms / 1000
+        query = {"_id": user, "state": "leased", "owner": self.worker_id}
+        update = [{"$set": {"lease_expires": {"$add": ["$$NOW", self.lease_ms]}}}]
+        if self.db.update_documents(LEASE_COLLECTION, query, update) != 1:
+            return False
+        self.lease_deadline = deadline
+        return True
+
+    def owns_lease(self) -> bool:
+        """Check if the current lease is still owned, before writing
+
+        Returns:
+            bool: False if the lease was lost or may have expired
+        """
+        return not self.lease_lost.is_set() and time.monotonic() < self.lease_deadline
+
+    def complete(self, user, user_doc) -> bool:
+        """Mark a user as done, storing the user document in the lease
+
+        Args:
+            user (str): id of the user
+            user_doc (dict | None): the user document with its activities,
+                None if the user has no trajectories
+
+        Returns:
+            bool: False if the lease is no longer owned by this worker
+        """
+        if not self.owns_lease():
+            return False
+        query = {"_id": user, "state": "leased", "owner": self.worker_id}
+        update = {
+            "$set": {"state": "done", "user": user_doc},
+            "$currentDate": {"finished": True},
+        }
+        return self.db.update_documents(LEASE_COLLECTION, query, update) == 1
+
+    def publish(self, lease):
+        """Write the user document of a completed lease, and remove the activities of the user
+        written by workers that lost the lease. Can be repeated.
+
+        Args:
+            lease (dict): the completed lease
+        """
+        user_doc = lease.get("user")
+        if user_doc is None:
+            return
+        data = {key: value for key, value in user_doc.items() if key != "_id"}
+        self.db.update_documents(
+            "User", {"_id": user_doc["_id"]}, {"$set": data}, upsert=True
+        )
+
+        if lease["attempts"] > 1 or lease["_id"] in self.lost:
+            activity_ids = [activity["_id"] for activity in user_doc["activities"]]
+            self.remove_partial_user(lease["_id"], keep=activity_ids)
+
+    def remove_partial_user(self, user, keep=None):
+        """Remove what a dead worker, or a worker that lost the lease, inserted for a user
+
+        Args:
+            user (str): id of the user
+            keep (list, optional): ids of the activities to keep,
+                None to remove the user with all activities. Defaults to None.
+        """
+        # Undo the sketch updates first, they are found from the sketch itself
+        remove_from_sketches(self.db, user, keep=keep or ())
+
+        activities = {"user_id": user}
+        trackpoints = {"user_id": user}
+        if keep is not None:
+            activities["_id"] = {"$nin": keep}
+            trackpoints["activity_id"] = {"$nin": keep}
+
+        for name in self.db.prune_partitions("TrackPoint"):
+            self.db.delete_documents(name, trackpoints)
+        self.db.delete_documents("Activity", activities)
+        self.db.delete_documents("RouteSignature", activities)
+        if keep is None:
+            self.db.delete_documents("User", {"_id": user})
+
+    def keep_renewing(self, user, stop: threading.Event):
+        """Renew the lease until stopped, runs in a separate thread
+
+        Args:
+            user (str): id of the user
+            stop (threading.Event): set when the user is inserted
+        """
+        while not stop.wait(self.lease_ms / 3000):
+            try:
+                renewed = self.renew(user)
+            except Exception as e:
+                print(f"Failed to renew the lease of user {user}:", e)
+                renewed = False
+            if not renewed:
+                self.lease_lost.set()
+                return
+
+    def ingest(self, lease) -> bool:
+        """Insert a claimed user while renewing the lease
+
+        Args:
+            lease (dict): the claimed lease
+
+        Returns:
+            bool: True if the user was inserted and marked as done
+        """
+        user = lease["_id"]
+        if lease["attempts"] > 1:
+            print(f"Reclaimed user {user}, removing partial insert")
+            self.remove_partial_user(user)
+
+        labeled_ids = read_labeled_users_file(
+            os.path.join(self.path_to_dataset, "labeled_ids.txt")
+        )
+        self.lease_lost.clear()
+        stop = threading.Event()
+        renewer = threading.Thread(target=self.keep_renewing, args=(user, stop))
+        renewer.start()
+        try:
+            inserted = insert_user(
+                self.db,
+                os.path.join(self.path_to_dataset, "Data", user),
+                labeled_ids,
+                self.options,
+                keep_going=self.owns_lease,
+                commit=lambda user_doc: self.complete(user, user_doc),
+            )
+        finally:
+            stop.set()
+            renewer.join()
+
+        if not inserted:
+            # What was written is removed by the worker that completes the user
+            print(f"Lost the lease of user {user}")
+            self.lost.add(user)
+            return False
+        lease = list(self.db.find_documents(LEASE_COLLECTION, {"_id": user}))[0]
+        self.publish(lease)
+        return True
+
+    def run(self, poll_interval=5.0) -> int:
+        """Claim and insert users until every user is done
+
+        Args:
+            poll_interval (float, optional): seconds to wait when all remaining users are leased.
+                Defaults to 5.0.
+
+        Returns:
+            int: number of users inserted by this worker
+        """
+        inserted = 0
+        start = time.time()
+        while True:
+            lease = self.claim()
+            if lease is not None:
+                inserted += self.ingest(lease)
+                continue
+
+            # Users leased by other workers may still expire
+            remaining = self.db.find_documents(
+                LEASE_COLLECTION, {"state": {"$ne": "done"}}, {"_id": 1}
+            )
+            if len(list(remaining)) == 0:
+                break
+            time.sleep(poll_interval)
+
+        # Every user is done. Write the users of workers that died after completing them,
+        # and remove what this worker wrote for the users it lost.
+        users = self.db.find_documents("User", {}, {"_id": 1})
+        users = {user["_id"] for user in users}
+        for lease in self.db.find_documents(LEASE_COLLECTION, {"state": "done"}):
+            if lease["_id"] not in users or lease["_id"] in self.lost:
+                self.publish(lease)
+
+        elapsed = time.time() - start
+        print(
+            f"Worker {self.worker_id} inserted {inserted} users in {elapsed:.1f}s "
+            f"({inserted / max(elapsed, 1e-9):.2f} users/s)"
+        )
+        return inserted
+
+
+def run_worker(path_to_dataset, lease_seconds):
+    """Run a worker with its own connection, the target of a worker process
+
+    Args:
+        path_to_dataset (str): path to the dataset
+        lease_seconds (float): duration of a lease
+    """
+    db = DbHandler()
+    try:
+        worker = LeaseWorker(
+            db, path_to_dataset, lease_seconds, options=get_ingest_options()
+        )
+        worker.seed_queue()
+        worker.run()
+    finally:
+        db.connection.close_connection()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reset", action="store_true", help="clear db and queue")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--lease-seconds", type=float, default=60)
+    parser.add_argument("--dataset", default="./dataset")
+    args = parser.parse_args()
+
+    if args.reset:
+        db = DbHandler()
+        db.drop_all_coll()
+        db.connection.close_connection()
+        return
+
+    start = time.time()
+    workers = [
+        Process(target=run_worker, args=(args.dataset, args.lease_seconds))
+        for _ in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print(f"Time used: {time.time() - start}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Continuous ingest of new trajectory files.
+
+Watches Data/<user>/Trajectory for new .plt files, and inserts them as they arrive.
+A file is inserted when its size is unchanged between two polls (the upload is complete).
+A file that fails to insert is logged and retried a few times, and again if it is changed.
+The activity of a file has an id derived from its path, so before a retry
+what the failed attempt wrote is found and removed.
+The latency from file arrival (modification time) until the trackpoints are visible
+to the part 2 queries (read with the analytics read preference) is measured for every file.
+
+Usage: python ingest_watcher.py [poll interval in seconds]
+"""
+import hashlib
+import os
+import sys
+import time
+from bson import ObjectId
+from DbHandler import DbHandler
+from FileHandler import read_labeled_users_file, read_user_labels_file
+from part1 import get_ingest_options, insert_trajectory
+from Sketches import remove_from_sketches
+
+
+class TrajectoryWatcher:
+    """Polls the dataset for new trajectory files and inserts them"""
+
+    def __init__(
+        self,
+        db: DbHandler,
+        path_to_dataset="./dataset",
+        options=None,
+        max_attempts=3,
+        visible_timeout=30.0,
+    ):
+        self.db = db
+        self.path_to_dataset = path_to_dataset
+        self.options = options
+        self.max_attempts = max_attempts
+        self.visible_timeout = visible_timeout
+        self.seen = set()  # inserted or skipped files
+        self.failed = {}  # path -> (size, mtime, attempts) of files that failed to insert
+        self.pending = {}  # path -> size at last poll
+        self.labels = {}  # user -> (mtime of labels.txt, labels)
+        self.latencies = []
+
+    def find_files(self) -> dict:
+        """Find all the trajectory files in the dataset
+
+        Returns:
+            dict: path -> (user, size, mtime)
+        """
+        files = {}
+        path_to_data = os.path.join(self.path_to_dataset, "Data")
+        for user in os.listdir(path_to_data):
+            root = os.path.join(path_to_data, user, "Trajectory")
+            if not os.path.isdir(root):
+                continue
+            for entry in os.scandir(root):
+                if entry.name.endswith(".plt"):
+                    stat = entry.stat()
+                    files[entry.path] = (user, stat.st_size, stat.st_mtime)
+        return files
+
+    def skip_existing(self):
+        """Mark all the files currently in the dataset as inserted"""
+        self.seen.update(self.find_files())
+
+    def get_labels(self, user):
+        """Get the labeled activities of a user.
+        The labels are read again if labels.txt has changed.
+
+        Args:
+            user (str): id of the user
+
+        Returns:
+            dict | None: labeled activities
+        """
+        labeled_ids = read_labeled_users_file(
+            os.path.join(self.path_to_dataset, "labeled_ids.txt")
+        )
+        path = os.path.join(self.path_to_dataset, "Data", user, "labels.txt")
+        if user not in labeled_ids or not os.path.exists(path):
+            return None
+
+        mtime = os.path.getmtime(path)
+        if self.labels.get(user, (None,))[0] != mtime:
+            self.labels[user] = (mtime, read_user_labels_file(path))
+        return self.labels[user][1]
+
+    def poll(self) -> int:
+        """Insert the new files that are completely uploaded
+
+        Returns:
+            int: number of inserted activities
+        """
+        inserted = 0
+        for path, (user, size, mtime) in self.find_files().items():
+            if path in self.seen:
+                continue
+
+            # Wait until the size is stable
+            if self.pending.get(path) != size:
+                self.pending[path] = size
+                continue
+            del self.pending[path]
+
+            # Give up on a failing file until it is changed
+            size_mtime, attempts = (size, mtime), 0
+            if path in self.failed:
+                if self.failed[path][:2] == size_mtime:
+                    attempts = self.failed[path][2]
+                if attempts >= self.max_attempts:
+                    continue
+
+            try:
+                if path in self.failed:
+                    self.remove_activity(user, self.activity_id(path))
+                if self.insert_file(path, user, mtime):
+                    inserted += 1
+            except Exception as e:
+                attempts += 1
+                self.failed[path] = (size, mtime, attempts)
+                print(f"ERROR: Failed to insert {path} (attempt {attempts}):", e)
+                continue
+            self.failed.pop(path, None)
+            self.seen.add(path)
+        return inserted
+
+    def activity_id(self, path) -> ObjectId:
+        """The id of the activity of a file, the same on every attempt
+
+        Args:
+            path (str): path to the .plt file
+
+        Returns:
+            ObjectId: id of the activity
+        """
+        relative = os.path.relpath(path, self.path_to_dataset).replace(os.path.sep, "/")
+        return ObjectId(hashlib.blake2b(relative.encode("utf-8"), digest_size=12).digest())
+
+    def remove_activity(self, user, activity_id):
+        """Remove what an attempt to insert an activity wrote
+
+        Args:
+            user (str): id of the user
+            activity_id (ObjectId): id of the activity
+        """
+        remove_from_sketches(self.db, user, activity_ids=[activity_id])
+        for name in self.db.prune_partitions("TrackPoint"):
+            self.db.delete_documents(name, {"activity_id": activity_id})
+        self.db.delete_documents("RouteSignature", {"_id": activity_id})
+        self.db.delete_documents("Activity", {"_id": activity_id})
+        self.db.update_documents(
+            "User", {"_id": user}, {"$pull": {"activities": {"_id": activity_id}}}
+        )
+
+    def insert_file(self, path, user, mtime) -> bool:
+        """Insert an activity with its trackpoints, and append it to the user
+
+        Args:
+            path (str): path to the .plt file
+            user (str): id of the user
+            mtime (float): modification time of the file
+
+        Returns:
+            bool: True if the activity was inserted
+        """
+        root, file = os.path.split(path)
+        labels = self.get_labels(user)
+        activity = insert_trajectory(
+            self.db, user, root, file, labels, self.options, self.activity_id(path)
+        )
+        if activity is None:
+            print(f"Skipped {path}: too many trackpoints")
+            return False
+
+        # Append to the activities of the user, create the user if it is new
+        self.db.push_to_array(
+            "User",
+            user,
+            "activities",
+            activity,
+            defaults={"has_label": labels is not None},
+        )
+
+        # Wait until the trackpoints are visible where the part 2 queries read them
+        query = {"activity_id": activity["_id"]}
+        deadline = time.time() + self.visible_timeout
+        while not self.is_visible(query):
+            if time.time() > deadline:
+                print(f"Inserted {path}, not visible after {self.visible_timeout}s")
+                return True
+            time.sleep(0.01)
+        latency = time.time() - mtime
+        self.latencies.append(latency)
+        print(f"Inserted {path} for user {user}, latency {latency:.3f}s")
+        return True
+
+    def is_visible(self, query) -> bool:
+        """Check if a trackpoint matching the query can be read with the analytics read preference
+
+        Args:
+            query (dict): the filter
+
+        Returns:
+            bool: True if a trackpoint was found
+        """
+        ret = self.db.find_partitioned(
+            "TrackPoint", query, {"_id": 1}, read_preference=self.db.analytics
+        )
+        return next(iter(ret), None) is not None
+
+    def watch(self, interval=1.0):
+        """Poll for new files until interrupted
+
+        Args:
+            interval (float, optional): seconds between polls. Defaults to 1.0.
+        """
+        try:
+            while True:
+                self.poll()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        self.print_latencies()
+
+    def print_latencies(self):
+        """Print statistics of the ingest latencies, and the files that failed"""
+        for path, (_, _, attempts) in self.failed.items():
+            print(f"Not inserted after {attempts} attempts: {path}")
+        if len(self.latencies) == 0:
+            print("No activities inserted")
+            return
+        latencies = sorted(self.latencies)
+        print(f"Inserted {len(latencies)} activities")
+        print(
+            f"Latency: mean {sum(latencies) / len(latencies):.3f}s, "
+            f"median {latencies[len(latencies) // 2]:.3f}s, max {latencies[-1]:.3f}s"
+        )
+
+
+def main():
+    interval = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    db = None
+    try:
+        db = DbHandler()
+        watcher = TrajectoryWatcher(db, options=get_ingest_options())
+        watcher.skip_existing()
+        print(f"Watching for new trajectories every {interval}s, stop with Ctrl+C")
+        watcher.watch(interval)
+    except Exception as e:
+        print("ERROR: Failed to use database:", e)
+    finally:
+        if db:
+            db.connection.close_connection()
+
+
+if __name__ == "__main__":
+    main()
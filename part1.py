@@ -6,18 +6,46 @@ Raises:
 """
 import os
 import time
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Callable
+from decouple import config
 from DbHandler import DbHandler
 from FileHandler import read_data_file, read_labeled_users_file, read_user_labels_file
+from Profiler import profiler
+from RouteSignature import insert_signature
+from Sketches import update_sketches
 from structs import User, Activity, TrackPoint
+from TrajectorySimplifier import get_simplifier
 
 
-def parse_and_insert_dataset(db: DbHandler, stop_at_user=""):
+# Indexes of the trackpoints, on the collection or on every time partition.
+# Trackpoints of an activity in order, used by partitioned scans and $lookup
+TRACKPOINT_INDEXES = [[("activity_id", 1), ("date_time", 1)]]
+
+
+@dataclass
+class IngestOptions:
+    """Optional stages applied when inserting the dataset"""
+
+    # Reduce the trackpoints of an activity before insertion, e.g. douglas_peucker or decimate
+    simplifier: Callable = None
+    # Maintain the sketches used by the approximate queries
+    sketches: bool = False
+    # Insert the route signatures used by the route similarity search
+    signatures: bool = False
+    # Insert the trackpoints into one collection per "year" or "month", e.g. TrackPoint_2008
+    partition_by: str = None
+
+
+def parse_and_insert_dataset(db: DbHandler, stop_at_user="", options=None):
     """Will parse the dataset and insert the users,
     the activities and all the trackpoints for each activity.
 
     Args:
         program (DbHandler): the database
+        stop_at_user (str, optional): stop before inserting this user. Defaults to "".
+        options (IngestOptions, optional): optional ingest stages. Defaults to None.
     """
     path_to_dataset = os.path.join("./dataset")
 
@@ -25,45 +53,96 @@ def parse_and_insert_dataset(db: DbHandler, stop_at_user=""):
         os.path.join(path_to_dataset, "labeled_ids.txt")
     )
 
-    # Iterate over the dataset
-    for root, dirs, files in os.walk(os.path.join(path_to_dataset, "Data")):
-        # New user
-        if len(dirs) > 0 and dirs[0] == "Trajectory":
-            user, labels = get_new_user(root, labeled_ids, files)
-
-            # Partial insert, 0..stop_at_user-1
-            if user == stop_at_user:
-                return
-
-            # See if it has labels
-            if labels is None:
-                has_labels = False
-            else:
-                has_labels = True
-
-            # insert user into db
-            print(f"Inserting user {user}")
-            user_objectid = db.insert_documents(
-                "User", [User(user, has_labels, []).__dict__]
-            )[0]
-
-        # Insert activities with Trajectory data for the user
-        if os.path.normpath(root).split(os.path.sep)[-1] == "Trajectory":
-            activities = []
-            for file in files:
-                activity_with_transportation_mode = insert_trajectory(
-                    db,
-                    user_objectid,
-                    root,
-                    file,
-                    labels,
-                )
-                if activity_with_transportation_mode is not None:
-                    activities.append(activity_with_transportation_mode)
-
-            # Update user with activities
-            data_to_update = {"activities": activities}
-            db.update_document("User", user_objectid, data_to_update)
+    # Iterate over the users in the dataset
+    path_to_data = os.path.join(path_to_dataset, "Data")
+    with profiler.stage("walk"):
+        users = os.listdir(path_to_data)
+    for user in users:
+        # Partial insert, 0..stop_at_user-1
+        if user == stop_at_user:
+            return
+        insert_user(db, os.path.join(path_to_data, user), labeled_ids, options)
+
+
+def insert_user(
+    db: DbHandler, root, labeled_ids, options=None, keep_going=None, commit=None
+):
+    """Insert a user with all the activities and trackpoints in the users directory.
+    The user is inserted last, with its activities.
+
+    Args:
+        db (DbHandler): The database
+        root (str): path to users directory
+        labeled_ids (list): all users that have labeled their activities
+        options (IngestOptions, optional): optional ingest stages. Defaults to None.
+        keep_going (Callable, optional): checked before every activity,
+            the insertion is aborted if it returns False. Defaults to None.
+        commit (Callable, optional): writes the user document instead of inserting it,
+            returns False if it was not written. Called with None if the directory
+            has no trajectories. Defaults to None.
+
+    Returns:
+        bool: False if the insertion was aborted
+    """
+    options = options if options is not None else IngestOptions()
+    path_to_trajectory = os.path.join(root, "Trajectory")
+    if not os.path.isdir(path_to_trajectory):
+        return commit(None) if commit is not None else True
+
+    # Find the user, and see if it has labels
+    with profiler.stage("walk"):
+        files = [
+            file
+            for file in os.listdir(root)
+            if os.path.isfile(os.path.join(root, file))
+        ]
+        trajectory_files = os.listdir(path_to_trajectory)
+    with profiler.stage("read"):
+        user, labels = get_new_user(root, labeled_ids, files)
+    has_labels = labels is not None
+
+    print(f"Inserting user {user}")
+    user_objectid = user
+
+    # Insert activities with Trajectory data for the user
+    activities = []
+    for file in trajectory_files:
+        if keep_going is not None and not keep_going():
+            return False
+        activity_with_transportation_mode = insert_trajectory(
+            db,
+            user_objectid,
+            path_to_trajectory,
+            file,
+            labels,
+            options,
+        )
+        if activity_with_transportation_mode is not None:
+            activities.append(activity_with_transportation_mode)
+
+    # Insert user with activities
+    user_doc = User(user, has_labels, activities).__dict__
+    if commit is not None:
+        return commit(user_doc)
+    db.insert_documents("User", [user_doc])
+    return True
+
+
+def create_indexes(db: DbHandler):
+    """Create the indexes. Done after the insertion, as it is faster than maintaining them.
+
+    Args:
+        db (DbHandler): The database
+    """
+    for name in db.prune_partitions("TrackPoint"):
+        for keys in TRACKPOINT_INDEXES:
+            db.create_index(name, keys)
+
+    # Covers the time bucketed activity statistics, e.g. task 6
+    db.create_index("Activity", [("year", 1), ("month", 1), ("duration_seconds", 1)])
+
+    # Candidate lookup of the route similarity search
+    db.create_index("RouteSignature", [("bands", 1)])
 
 
 def get_new_user(root, labeled_ids, files):
@@ -88,7 +167,9 @@ def get_new_user(root, labeled_ids, files):
     return user, labels
 
 
-def insert_trajectory(db: DbHandler, user_id, root, file, labels):
+def insert_trajectory(
+    db: DbHandler, user_id, root, file, labels, options=None, activity_id=None
+):
     """Insert activities with trackpoint data
 
     Args:
@@ -97,6 +178,8 @@ def insert_trajectory(db: DbHandler, user_id, root, file, labels):
         root (str): Path to directory
         file (str): Name of current file (activity)
         labels (dict): Labeled activities
+        options (IngestOptions, optional): optional ingest stages. Defaults to None.
+        activity_id (ObjectID, optional): id of the activity. Defaults to None (new id).
 
     Raises:
         ValueError: If the insertion of activity failed
@@ -105,43 +188,71 @@ def insert_trajectory(db: DbHandler, user_id, root, file, labels):
         dict: id of activity with transportation mode
     """
     path = os.path.join(root, file)
-    data = read_data_file(path)[6:]
+    with profiler.stage("read"):
+        data = read_data_file(path)[6:]
 
     # Check file size
     if len(data) > 2500:
         return None
 
+    # Simplify the trajectory, keeping the original number of trackpoints on the activity
+    nr_trackpoints = len(data)
+    if options is not None and options.simplifier is not None:
+        with profiler.stage("simplify"):
+            data = options.simplifier(data)
+
     # Insert Activity
-    activity_id, transportation_mode = insert_activity(db, user_id, file, data, labels)
+    activity_id, transportation_mode = insert_activity(
+        db, user_id, file, data, labels, nr_trackpoints, activity_id
+    )
     if len(activity_id) == 0:
         raise ValueError(f"Activity {path} was not inserted!")
     else:
         activity_id = activity_id[0]
 
     # Prepare Trackpoints
-    trackpoints = []
-    for trackpoint in data:
-        lat = float(trackpoint[0])
-        lon = float(trackpoint[1])
-        altitude = int(round(float(trackpoint[3])))
-        date_days = float(trackpoint[4])
-        date_time = get_datetime_format(trackpoint[5], trackpoint[6])
-
-        # Append trackpoint
-        trackpoints.append(
-            TrackPoint(
-                user_id, activity_id, lat, lon, altitude, date_days, date_time
-            ).__dict__
-        )
+    with profiler.stage("parse"):
+        trackpoints = []
+        for trackpoint in data:
+            lat = float(trackpoint[0])
+            lon = float(trackpoint[1])
+            altitude = int(round(float(trackpoint[3])))
+            date_days = float(trackpoint[4])
+            date_time = get_datetime_format(trackpoint[5], trackpoint[6])
+
+            # Append trackpoint
+            trackpoints.append(
+                TrackPoint(
+                    user_id, activity_id, lat, lon, altitude, date_days, date_time
+                ).__dict__
+            )
 
     # Insert Trackpoints
-    _ = db.insert_documents("TrackPoint", trackpoints)
+    if options is not None and options.partition_by is not None:
+        _ = db.insert_partitioned(
+            "TrackPoint",
+            trackpoints,
+            options.partition_by,
+            indexes=TRACKPOINT_INDEXES,
+        )
+    else:
+        _ = db.insert_documents("TrackPoint", trackpoints)
+
+    if options is not None and options.sketches:
+        with profiler.stage("sketch"):
+            update_sketches(db, user_id, trackpoints)
+
+    if options is not None and options.signatures:
+        with profiler.stage("signature"):
+            insert_signature(db, activity_id, user_id, trackpoints)
 
     # return activity with transportation_mode
     return {"_id": activity_id, "transportation_mode": transportation_mode}
 
 
-def insert_activity(db: DbHandler, user_id, file, data, labels):
+def insert_activity(
+    db: DbHandler, user_id, file, data, labels, nr_trackpoints=None, activity_id=None
+):
     """Insert an activity into the database
 
     Args:
@@ -150,6 +261,8 @@ def insert_activity(db: DbHandler, user_id, file, data, labels):
         file (str): Filename of the activity
         data (list[list]): All the trackpoints for the activity
         labels (dict): Labeled activities
+        nr_trackpoints (int, optional): trackpoints before simplification. Defaults to len(data).
+        activity_id (ObjectID, optional): id of the activity. Defaults to None (new id).
 
     Returns:
         list: ObjectID of inserted data. In this case, only one element
@@ -160,22 +273,71 @@ def insert_activity(db: DbHandler, user_id, file, data, labels):
     end_date_time = get_datetime_format(data[-1][5], data[-1][6])
 
     # Match Transportation mode
-    transportation_mode = None
-    if labels is not None:
-        # Get activity from dict
-        activity = labels.get(os.path.splitext(file)[0])  # Match start time on filename
-        if activity is not None:
-            # Match end time
-            if get_datetime_format(activity[2], activity[3]) == end_date_time:
-                transportation_mode = activity[4]
+    with profiler.stage("label match"):
+        transportation_mode = match_transportation_mode(file, end_date_time, labels)
 
     # Insert
-    activity = Activity(user_id, transportation_mode, start_date_time, end_date_time)
+    activity = Activity(
+        user_id,
+        transportation_mode,
+        start_date_time,
+        end_date_time,
+        nr_trackpoints if nr_trackpoints is not None else len(data),
+        start_date_time.year,
+        start_date_time.month,
+        (end_date_time - start_date_time).total_seconds(),
+    )
 
-    ids = db.insert_documents("Activity", [activity.__dict__])
+    doc = activity.__dict__
+    if activity_id is not None:
+        doc = {"_id": activity_id, **doc}
+    ids = db.insert_documents("Activity", [doc])
     return ids, transportation_mode
 
 
+def match_transportation_mode(file, end_date_time, labels):
+    """Find the transportation mode of an activity.
+    The label must match both the start time (filename) and the end time of the activity.
+
+    Args:
+        file (str): Filename of the activity
+        end_date_time (datetime): end time of the activity
+        labels (dict | None): Labeled activities
+
+    Returns:
+        str | None: Transportation mode
+    """
+    if labels is None:
+        return None
+
+    # Get activity from dict
+    activity = labels.get(os.path.splitext(file)[0])  # Match start time on filename
+    if activity is not None:
+        # Match end time
+        if get_datetime_format(activity[2], activity[3]) == end_date_time:
+            return activity[4]
+    return None
+
+
+def get_ingest_options() -> IngestOptions:
+    """Read the optional ingest stages from the .env file
+
+    Returns:
+        IngestOptions: the configured ingest stages
+    """
+    options = IngestOptions()
+    options.simplifier = get_simplifier(
+        config("SIMPLIFY_METHOD", default="douglas_peucker", cast=str),
+        config("SIMPLIFY_TOLERANCE", default=0, cast=float),
+        config("SIMPLIFY_MIN_SECONDS", default=10, cast=float),
+        config("SIMPLIFY_MAX_SECONDS", default=60, cast=float),
+    )
+    options.sketches = config("SKETCHES", default=False, cast=bool)
+    options.signatures = config("SIGNATURES", default=False, cast=bool)
+    options.partition_by = config("TRACKPOINT_PARTITION", default="", cast=str) or None
+    return options
+
+
 def get_datetime_format(date, the_time) -> datetime:
     """Convert the date and time to datetime format
 
@@ -191,23 +353,36 @@ def get_datetime_format(date, the_time) -> datetime:
     )
 
 
+def load_dataset(db: DbHandler, options=None, stop_at_user=""):
+    """Clear the database, insert the dataset and create the indexes
+
+    Args:
+        db (DbHandler): The database
+        options (IngestOptions, optional): optional ingest stages. Defaults to None.
+        stop_at_user (str, optional): stop before inserting this user. Defaults to "".
+    """
+    # Clear DB
+    db.drop_all_coll()
+
+    # Create collections
+    db.create_coll("User")
+    db.create_coll("Activity")
+    db.create_coll("TrackPoint")
+    print(db.get_coll())  # Print collections
+
+    # Insert data
+    parse_and_insert_dataset(db, stop_at_user, options)
+    create_indexes(db)
+
+
 def main():
     db = None
     try:
         db = DbHandler()
 
-        # Clear DB
-        db.drop_all_coll()
-
-        # Create collections
-        db.create_coll("User")
-        db.create_coll("Activity")
-        db.create_coll("TrackPoint")
-        print(db.get_coll())  # Print collections
-
         # Insert data
         start = time.time()
-        parse_and_insert_dataset(db)
+        load_dataset(db, get_ingest_options())
         end = time.time()
         print(f"Time used: {end - start}")
 
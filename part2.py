@@ -1,10 +1,16 @@
+"""This file solves the part 2 of assignment 3:
+Querying the dataset in the mongodb database.
+
+Every task prints its result and returns it.
+The tasks scanning the trackpoints read from secondaries when connected to a replica set.
+pandas, tabulate and haversine are imported where they are used, to keep the startup fast.
+"""
 import itertools
 import time
-import pandas as pd
 import pprint as pp
-from tabulate import tabulate
-from haversine import haversine, Unit
+from datetime import timedelta
 from DbHandler import DbHandler
+from Profiler import profiler
 
 
 def task_1(db: DbHandler):
@@ -12,13 +18,17 @@ def task_1(db: DbHandler):
     tables = {}
     tables["User"] = db.get_nr_documents("User")
     tables["Activity"] = db.get_nr_documents("Activity")
-    tables["TrackPoint"] = db.get_nr_documents("TrackPoint")
+    tables["TrackPoint"] = sum(
+        db.get_nr_documents(name, db.analytics)
+        for name in db.prune_partitions("TrackPoint")
+    )
 
     # Print
     print("\nTask 1")
     print(
         f"Total amount of rows in tables: \n{tabulate_dict(tables, ['Table', 'Rows'])}"
     )
+    return tables
 
 
 def task_2(db: DbHandler):
@@ -28,6 +38,7 @@ def task_2(db: DbHandler):
     # Print
     print("\nTask 2")
     print(f"Average number of activities per user is {average}")
+    return average
 
 
 def task_3(db: DbHandler):
@@ -45,7 +56,9 @@ def task_3(db: DbHandler):
     # Print
     print("\nTask 3")
     print("Top 20 users with the highest number of activities: ")
-    pp.pprint(list(ret))
+    ret = list(ret)
+    pp.pprint(ret)
+    return ret
 
 
 def task_4(db: DbHandler):
@@ -58,7 +71,9 @@ def task_4(db: DbHandler):
     # Print
     print("\nTask 4")
     print("All users who have taken a taxi:")
-    pp.pprint(list(ret))
+    ret = list(ret)
+    pp.pprint(ret)
+    return ret
 
 
 def task_5(db: DbHandler):
@@ -79,7 +94,9 @@ def task_5(db: DbHandler):
     # Print
     print("\nTask 5")
     print("Number of activities for the different transportation modes")
-    pp.pprint(list(ret))
+    ret = list(ret)
+    pp.pprint(ret)
+    return ret
 
 
 def task_6(db: DbHandler):
@@ -87,86 +104,36 @@ def task_6(db: DbHandler):
     a) Find the year with the most activities.
     b) Is this also the year with most recorded hours?
     """
-    # Get year with most activities
-    pipeline = []
+    # Activities and recorded hours per year, grouped on the server
+    years = db.time_bucketed_stats("Activity", ("year",))
 
-    # Convert start_date_time to year
-    pipeline.append({"$project": {"_id": 1, "year": {"$year": "$start_date_time"}}})
-    pipeline.append({"$group": {"_id": "$year", "count": {"$sum": 1}}})  # Group by year
-    pipeline.append({"$sort": {"count": -1}})
-    pipeline.append({"$limit": 1})  # Get top 1
-
-    # Query
-    ret = db.aggregate("Activity", pipeline)
-    most_activities_year = list(ret)[0]["_id"]
-
-    # Get year with most recorded hours
-    pipeline = []
-    pipeline.append(
-        {
-            "$project": {
-                "_id": 0,
-                "year": {"$year": "$start_date_time"},
-                "start_date_time": 1,
-                "end_date_time": 1,
-            }
-        }
-    )
-    # Query
-    ret = db.aggregate("Activity", pipeline)
-
-    # Calculate
-    recorded_hours = {}
-    for tp in ret:
-        year = tp["year"]
-        start = tp["start_date_time"]
-        finish = tp["end_date_time"]
-
-        # Update
-        recorded_hours[year] = (
-            recorded_hours[year] + (finish - start)
-            if recorded_hours.get(year) is not None  # Update if exist in dict
-            else (finish - start)  # First time? Insert value
-        )
-
-    # Convert to hours
-    # source: https://stackoverflow.com/a/47207182
-    for key, val in recorded_hours.items():
-        recorded_hours[key] = divmod(val.seconds, 3600)[0]
-
-    # Most hours
-    most_recorded_hours_year = max(recorded_hours, key=recorded_hours.get)
+    most_activities_year = max(years, key=lambda x: x["count"])["_id"]["year"]
+    most_recorded_hours_year = max(years, key=lambda x: x["hours"])["_id"]["year"]
 
     # Print
     print("\nTask 6")
     print(f"Year with most activities: {most_activities_year}")
     print(f"Year with most recorded hours: {most_recorded_hours_year}")
+    return {
+        "most_activities_year": most_activities_year,
+        "most_recorded_hours_year": most_recorded_hours_year,
+        "years": years,
+    }
 
 
 def task_7(db: DbHandler):
     """Find the total distance (in km) walked in 2008, by user with id=112."""
+    # The year is precomputed at ingest
+    match = {"user_id": "112", "transportation_mode": "walk", "year": 2008}
+    if len(db.get_partitions("TrackPoint")) > 0:
+        ret = partitioned_activity_trackpoints(db, match)
+        return print_task_7(walked_distance(ret))
+
     # Get year with most activities
     pipeline = []
 
-    # get year
-    pipeline.append(
-        {
-            "$addFields": {
-                "year": {"$year": "$start_date_time"},
-            }
-        }
-    )
-
     # Match
-    pipeline.append(
-        {
-            "$match": {
-                "user_id": "112",
-                "transportation_mode": "walk",
-                "year": 2008,
-            }
-        }
-    )
+    pipeline.append({"$match": match})
 
     # Get lat/lon for each activity
     pipeline.append(
@@ -193,11 +160,58 @@ def task_7(db: DbHandler):
     pipeline.append({"$project": {"trackpoints": 1}})
 
     # Query
-    ret = db.aggregate("Activity", pipeline)
+    ret = db.aggregate("Activity", pipeline, read_preference=db.analytics)
+    return print_task_7(walked_distance(ret))
+
+
+def partitioned_activity_trackpoints(db: DbHandler, match: dict) -> list:
+    """Get the lat/lon of the trackpoints for each activity matching a query,
+    reading only the trackpoint partitions in the time range of the activities.
+
+    Args:
+        db (DbHandler): The database
+        match (dict): the filter on the activities
+
+    Returns:
+        list: [{"trackpoints": [{"lat", "lon"}, ...]}, ...]
+    """
+    fields = {"_id": 1, "start_date_time": 1, "end_date_time": 1}
+    activities = list(db.find_documents("Activity", match, fields))
+    if len(activities) == 0:
+        return []
+
+    # Time range of the activities
+    start = min(activity["start_date_time"] for activity in activities)
+    end = max(activity["end_date_time"] for activity in activities)
+    ret = db.find_partitioned(
+        "TrackPoint",
+        {"activity_id": {"$in": [activity["_id"] for activity in activities]}},
+        {"_id": 0, "activity_id": 1, "lat": 1, "lon": 1},
+        start=start,
+        end=end + timedelta(seconds=1),
+        read_preference=db.analytics,
+    )
+
+    # Group per activity, the partitions are read in time order
+    trackpoints = {}
+    for tp in ret:
+        trackpoints.setdefault(tp["activity_id"], []).append(tp)
+    return [{"trackpoints": tps} for tps in trackpoints.values()]
+
+
+def walked_distance(activities) -> float:
+    """Calculate the total distance (in km) of activities
+
+    Args:
+        activities (Iterable[dict]): activities with a list of trackpoints (lat/lon)
+
+    Returns:
+        float: the distance
+    """
+    from haversine import haversine, Unit
 
-    # Calculate
     distance = 0.0
-    for activity in ret:
+    for activity in activities:
         old_track_point = None
         for track_point in activity["trackpoints"]:
             # Calculate the distance between the trackpoints (coordinates)
@@ -209,28 +223,81 @@ def task_7(db: DbHandler):
                     unit=Unit.KILOMETERS,
                 )
             old_track_point = track_point
+    return distance
 
-    # Print
+
+def print_task_7(distance) -> float:
+    """Print the result of task 7
+
+    Args:
+        distance (float): the distance walked
+
+    Returns:
+        float: the distance
+    """
     print("\nTask 7")
     print(f"User 112 walked {round(distance, 3)} km in 2008")
+    return distance
+
 
+def task_8(db: DbHandler, partitions=None):
+    """Find the top 20 users who have gained the most altitude meters
 
-def task_8(db: DbHandler):
-    """Find the top 20 users who have gained the most altitude meters"""
+    Args:
+        db (DbHandler): The database
+        partitions (int, optional): scan the trackpoints in parallel. Defaults to None.
+    """
     fields = {"_id": 0, "user_id": 1, "activity_id": 1, "altitude": 1}
-    ret = db.find_documents(collection_name="TrackPoint", fields=fields)
+    if partitions is None:
+        # Every time partition, oldest first, or the whole collection
+        ret = db.find_partitioned("TrackPoint", fields=fields, read_preference=db.analytics)
+        altitude = gained_altitude(ret)
+    else:
+        # Each worker reads the trackpoints of its activities from every time partition
+        altitude = db.partitioned_scan(
+            "TrackPoint",
+            "activity_id",
+            gained_altitude,
+            merge_counts,
+            fields=fields,
+            sort=[("activity_id", 1), ("date_time", 1)],
+            partitions=partitions,
+            read_preference=db.analytics,
+        )
+
+    # Sort dict
+    # source: https://stackoverflow.com/a/2258273
+    altitude = dict(sorted(altitude.items(), key=lambda x: x[1], reverse=True))
+    top_users = dict(itertools.islice(altitude.items(), 20))
+
+    # Print
+    print("\nTask 8")
+    print(
+        f"The 20 users who gained the most altitude meters is: \n{tabulate_dict(top_users, ['User', 'Gained Altitude (m)'])}"
+    )
+    return top_users
+
 
-    # Calculate
+def gained_altitude(trackpoints) -> dict:
+    """Calculate the gained altitude per user.
+    The trackpoints of an activity must be in order, but may be interleaved with other activities.
+
+    Args:
+        trackpoints (Iterable[dict]): trackpoints with user_id, activity_id and altitude
+
+    Returns:
+        dict: user_id -> gained altitude
+    """
     altitude = {}
-    current_aid = -1
-    old_alt = -1
-    for tp in ret:
+    old_alts = {}  # activity_id -> previous altitude
+    for tp in trackpoints:
         uid = tp["user_id"]
         aid = tp["activity_id"]
         alt = tp["altitude"]
 
         # Same activity
-        if aid == current_aid:
+        old_alt = old_alts.get(aid)
+        if old_alt is not None:
             # Not invalid + new alt is higher
             if old_alt < alt and alt != -777 and old_alt != -777:
                 diff = alt - old_alt
@@ -238,52 +305,84 @@ def task_8(db: DbHandler):
                 altitude[uid] = (
                     altitude[uid] + diff if altitude.get(uid) is not None else diff
                 )
-        else:
-            # New activity
-            current_aid = aid
-        old_alt = alt
-
-    # Sort dict
-    # source: https://stackoverflow.com/a/2258273
-    altitude = dict(sorted(altitude.items(), key=lambda x: x[1], reverse=True))
-    top_users = dict(itertools.islice(altitude.items(), 20))
-
-    # Print
-    print("\nTask 8")
-    print(
-        f"The 20 users who gained the most altitude meters is: \n{tabulate_dict(top_users, ['User', 'Gained Altitude (m)'])}"
-    )
+        old_alts[aid] = alt
+    return altitude
 
 
-def task_9(db: DbHandler):
+def task_9(db: DbHandler, partitions=None):
     """Find all users who have invalid activities, and the number of invalid activities per user
     An invalid activity is defined as an activity with consecutive
     trackpoints where the timestamps deviate with at least 5 minutes.
+
+    Args:
+        db (DbHandler): The database
+        partitions (int, optional): scan the trackpoints in parallel. Defaults to None.
     """
     fields = {"_id": 0, "user_id": 1, "activity_id": 1, "date_time": 1}
-    ret = db.find_documents(collection_name="TrackPoint", fields=fields)
+    if partitions is None:
+        # Every time partition, oldest first, or the whole collection
+        ret = db.find_partitioned("TrackPoint", fields=fields, read_preference=db.analytics)
+        users = invalid_activities(ret)
+    else:
+        # Each worker reads the trackpoints of its activities from every time partition
+        users = db.partitioned_scan(
+            "TrackPoint",
+            "activity_id",
+            invalid_activities,
+            merge_counts,
+            fields=fields,
+            sort=[("activity_id", 1), ("date_time", 1)],
+            partitions=partitions,
+            read_preference=db.analytics,
+        )
 
-    # Find users
+    # Print
+    print("\nTask 9")
+    print(
+        f"Users with invalid activities: \n{tabulate_dict(users, ['User', 'Invalid Activities'])}"
+    )
+    return users
+
+
+def invalid_activities(trackpoints) -> dict:
+    """Count the invalid activities per user.
+    The trackpoints of an activity must be in order, but may be interleaved with other activities.
+
+    Args:
+        trackpoints (Iterable[dict]): trackpoints with user_id, activity_id and date_time
+
+    Returns:
+        dict: user_id -> number of invalid activities
+    """
     users = {}
-    curr_aid = -1
-    old_dt = None
-    for tp in ret:
+    old_dts = {}  # activity_id -> previous date_time
+    for tp in trackpoints:
         uid, aid, dt = tp["user_id"], tp["activity_id"], tp["date_time"]
         # If same activity
-        if aid == curr_aid:
+        old_dt = old_dts.get(aid)
+        if old_dt is not None:
             # Calulate the time between the trackpoints in minutes
             diff = divmod((dt - old_dt).total_seconds(), 60)[0]
             if diff >= 5:
                 users[uid] = users[uid] + 1 if users.get(uid) is not None else 1
-        else:
-            curr_aid = aid
-        old_dt = dt
+        old_dts[aid] = dt
+    return users
 
-    # Print
-    print("\nTask 9")
-    print(
-        f"Users with invalid activities: \n{tabulate_dict(users, ['User', 'Invalid Activities'])}"
-    )
+
+def merge_counts(a: dict, b: dict) -> dict:
+    """Merge two dicts by adding the values of equal keys
+
+    Args:
+        a (dict): key -> number
+        b (dict): key -> number
+
+    Returns:
+        dict: key -> sum of numbers
+    """
+    merged = dict(a)
+    for key, val in b.items():
+        merged[key] = merged.get(key, 0) + val
+    return merged
 
 
 def task_10(db: DbHandler):
@@ -308,12 +407,14 @@ def task_10(db: DbHandler):
     pipeline.append({"$group": {"_id": "$user_id"}})  # find users
 
     # Query
-    res = db.aggregate("TrackPoint", pipeline)
+    res = db.aggregate_partitioned("TrackPoint", pipeline, read_preference=db.analytics)
 
     # Print
     print("\nTask 10")
     print("Users that have visited 'the Forbidden City':")
-    pp.pprint(list(res))
+    res = list(res)
+    pp.pprint(res)
+    return res
 
 
 def task_11(db: DbHandler):
@@ -392,7 +493,9 @@ def task_11(db: DbHandler):
     print(
         "All users who have registered transportation_mode and their most used transportation_mode:"
     )
-    pp.pprint(list(res))
+    res = list(res)
+    pp.pprint(res)
+    return res
 
 
 def tabulate_dict(data, headers) -> str:
@@ -405,10 +508,28 @@ def tabulate_dict(data, headers) -> str:
     Returns:
         str: tabulated data
     """
+    import pandas as pd
+    from tabulate import tabulate
+
     df = pd.DataFrame(data, index=[0]).transpose()
     return tabulate(df, headers=headers, floatfmt=".0f")
 
 
+TASKS = {
+    1: task_1,
+    2: task_2,
+    3: task_3,
+    4: task_4,
+    5: task_5,
+    6: task_6,
+    7: task_7,
+    8: task_8,
+    9: task_9,
+    10: task_10,
+    11: task_11,
+}
+
+
 def main():
     db = None
     try:
@@ -416,17 +537,9 @@ def main():
         start = time.time()
 
         # Execute the tasks:
-        task_1(db)
-        task_2(db)
-        task_3(db)
-        task_4(db)
-        task_5(db)
-        task_6(db)
-        task_7(db)
-        task_8(db)
-        task_9(db)
-        task_10(db)
-        task_11(db)
+        for nr, task in TASKS.items():
+            with profiler.stage(f"task_{nr}"):
+                task(db)
 
         end = time.time()
         print(f"Time used: {end - start}")
@@ -0,0 +1,174 @@
+"""Approximate versions of the part 2 tasks scanning the trackpoints.
+
+The results are estimates with an error bound, computed at a small fraction
+of the cost of the exact tasks:
+- task 8 reads the count-min sketch of the gained altitude per user
+- task 9 reads the trackpoints of a $sample of the activities, and scales the sample
+- task 10 reads the HyperLogLog of the users in the region
+Task 8 and 10 need the sketches, maintained at ingest with SKETCHES=True.
+"""
+from datetime import timedelta
+from math import sqrt
+from DbHandler import DbHandler
+from Sketches import cm_error_bound, cm_estimate, hll_estimate, region_key
+from part2 import invalid_activities, tabulate_dict
+
+Z_95 = 1.96  # 95% confidence
+
+
+def task_8(db: DbHandler) -> dict:
+    """Estimate the top 20 users who have gained the most altitude meters"""
+    fields = {"table": 1, "total": 1}
+    sketch = list(db.find_documents("Sketch", {"_id": "altitude_gain"}, fields))
+    if len(sketch) == 0:
+        raise ValueError("No altitude sketch, insert the dataset with SKETCHES=True")
+    table, total = sketch[0]["table"], sketch[0]["total"]
+
+    # Estimate every user, there are few users
+    users = db.find_documents("User", fields={"_id": 1})
+    altitude = {user["_id"]: cm_estimate(table, user["_id"]) for user in users}
+    top_users = dict(sorted(altitude.items(), key=lambda x: x[1], reverse=True)[:20])
+    bound, probability = cm_error_bound(total)
+
+    # Print
+    print("\nTask 8 (approximate)")
+    print(
+        f"The 20 users who gained the most altitude meters is: \n{tabulate_dict(top_users, ['User', 'Gained Altitude (m)'])}"
+    )
+    print(
+        f"Each estimate is at most {bound:.0f} m too high, "
+        f"with probability {probability:.3f}"
+    )
+    return {
+        "top_users": top_users,
+        "error_bound": bound,
+        "confidence": probability,
+        "method": "count-min sketch",
+    }
+
+
+def task_9(db: DbHandler, sample_size=500) -> dict:
+    """Estimate the number of invalid activities, in total and per user.
+    As in the exact task 9, an invalid activity is counted once for every pair of
+    consecutive trackpoints where the timestamps deviate with at least 5 minutes.
+
+    Args:
+        db (DbHandler): The database
+        sample_size (int, optional): number of sampled activities. Defaults to 500.
+    """
+    nr_activities = db.get_nr_documents("Activity")
+    pipeline = []
+    pipeline.append({"$sample": {"size": sample_size}})
+    pipeline.append(
+        {"$project": {"user_id": 1, "start_date_time": 1, "end_date_time": 1}}
+    )
+
+    # Query
+    activities = list(db.aggregate("Activity", pipeline, read_preference=db.analytics))
+    if len(activities) == 0:
+        raise ValueError("No activities to sample")
+
+    # Get the timestamps of the trackpoints for each sampled activity,
+    # from the time partitions of the sampled activities
+    start = min(activity["start_date_time"] for activity in activities)
+    end = max(activity["end_date_time"] for activity in activities)
+    ret = db.find_partitioned(
+        "TrackPoint",
+        {"activity_id": {"$in": [activity["_id"] for activity in activities]}},
+        {"_id": 0, "user_id": 1, "activity_id": 1, "date_time": 1},
+        start=start,
+        end=end + timedelta(seconds=1),
+        read_preference=db.analytics,
+    )
+    trackpoints = {activity["_id"]: [] for activity in activities}
+    for tp in ret:
+        trackpoints[tp["activity_id"]].append(tp)
+
+    # Count the invalid activities of each sampled activity
+    counts = []  # (user_id, count)
+    for activity in activities:
+        tps = sorted(trackpoints[activity["_id"]], key=lambda tp: tp["date_time"])
+        counts.append((activity["user_id"], sum(invalid_activities(tps).values())))
+
+    # Scale the sample to all activities, with 95% confidence intervals
+    estimate, bound = scale_sample([n for _, n in counts], nr_activities)
+    users = {}
+    for uid in sorted({uid for uid, n in counts if n > 0}):
+        # Counts of the other users are 0 for this user
+        user_counts = [n if other == uid else 0 for other, n in counts]
+        users[uid] = scale_sample(user_counts, nr_activities)
+
+    # Print
+    print("\nTask 9 (approximate)")
+    print(
+        f"Estimated invalid activities: {estimate:.0f} ± {bound:.0f} (95% confidence), "
+        f"from {len(counts)} of {nr_activities} activities"
+    )
+    rows = {uid: f"{n:.0f} ± {b:.0f}" for uid, (n, b) in users.items()}
+    print(
+        f"Users with invalid activities: \n{tabulate_dict(rows, ['User', 'Invalid Activities (95%)'])}"
+    )
+    return {
+        "estimate": estimate,
+        "error_bound": bound,
+        "confidence": 0.95,
+        "users": {
+            uid: {"estimate": n, "error_bound": b} for uid, (n, b) in users.items()
+        },
+        "method": "$sample",
+    }
+
+
+def scale_sample(values: list, population: int) -> tuple:
+    """Estimate the total of a population from a simple random sample,
+    with the 95% confidence bound of the normal approximation
+
+    Args:
+        values (list): value of each sampled element
+        population (int): number of elements in the population
+
+    Returns:
+        tuple: (estimate, bound)
+    """
+    n = len(values)
+    if n == 0:
+        return 0.0, 0.0
+    mean = sum(values) / n
+    variance = sum((x - mean) ** 2 for x in values) / max(n - 1, 1)
+    correction = (population - n) / max(population - 1, 1)  # finite population
+    return population * mean, Z_95 * population * sqrt(variance / n * correction)
+
+
+def task_10(db: DbHandler, lat=39.916, lon=116.397) -> dict:
+    """Estimate the number of users who have tracked an activity in the Forbidden City of Beijing.
+    the Forbidden City: lat 39.916, lon 116.397
+
+    Args:
+        db (DbHandler): The database
+        lat (float, optional): latitude of the region. Defaults to 39.916.
+        lon (float, optional): longitude of the region. Defaults to 116.397.
+    """
+    region = region_key(lat, lon)
+    sketch = list(db.find_documents("RegionSketch", {"_id": region}))
+    registers = sketch[0]["registers"] if len(sketch) > 0 else {}
+    estimate, standard_error = hll_estimate(registers)
+    bound = Z_95 * standard_error
+
+    # Print
+    print("\nTask 10 (approximate)")
+    print(
+        f"Estimated users that have visited {region}: {estimate:.1f} ± {bound:.1f} (95% confidence)"
+    )
+    return {
+        "estimate": estimate,
+        "error_bound": bound,
+        "confidence": 0.95,
+        "method": "HyperLogLog",
+    }
+
+
+TASKS = {
+    8: task_8,
+    9: task_9,
+    10: task_10,
+}
@@ -0,0 +1,74 @@
+"""Checks that a profiled ingest inserts a user with all its activities and trackpoints.
+
+Inserts one user of the dataset with the profiler enabled into a scratch database
+(<DATABASE>_profile_check, dropped afterwards), and compares the inserted documents
+with an ingest of the same user without the profiler.
+Fails if the user, its activities or its trackpoints differ.
+
+Usage: python profile_ingest_check.py [user, defaults to the first user in the dataset]
+"""
+import os
+import sys
+from DbConnector import DbConnector
+from DbHandler import DbHandler
+from FileHandler import read_labeled_users_file
+from Profiler import profiler
+from part1 import insert_user
+
+
+def ingest_user(db: DbHandler, user, path_to_dataset="./dataset") -> dict:
+    """Insert a user into an empty database, and count what was inserted
+
+    Args:
+        db (DbHandler): The database
+        user (str): id of the user
+        path_to_dataset (str, optional): path to the dataset. Defaults to "./dataset".
+
+    Returns:
+        dict: number of activities on the user, activities and trackpoints
+    """
+    db.drop_all_coll()
+    labeled_ids = read_labeled_users_file(
+        os.path.join(path_to_dataset, "labeled_ids.txt")
+    )
+    insert_user(db, os.path.join(path_to_dataset, "Data", user), labeled_ids)
+
+    users = list(db.find_documents("User", {"_id": user}))
+    return {
+        "users": len(users),
+        "user activities": len(users[0]["activities"]) if users else 0,
+        "activities": db.get_nr_documents("Activity"),
+        "trackpoints": db.get_nr_documents("TrackPoint"),
+    }
+
+
+def main():
+    user = sys.argv[1] if len(sys.argv) > 1 else sorted(os.listdir("./dataset/Data"))[0]
+    # The configured connection (and authentication database), with a scratch database
+    configured = DbConnector()
+    uri, database = configured.uri, configured.database + "_profile_check"
+    configured.close_connection()
+    db = DbHandler(DbConnector(DATABASE=database, URI=uri))
+    try:
+        expected = ingest_user(db, user)
+
+        profiler.enable()
+        try:
+            profiled = ingest_user(db, user)
+        finally:
+            profiler.disable()
+        print(profiler.report())
+
+        print(f"Without profiler: {expected}")
+        print(f"With profiler:    {profiled}")
+        if profiled != expected or expected["users"] != 1:
+            print("FAILED: the profiled ingest differs")
+            sys.exit(1)
+        print("The profiled ingest inserted the same documents")
+    finally:
+        db.client.drop_database(database)
+        db.connection.close_connection()
+
+
+if __name__ == "__main__":
+    main()
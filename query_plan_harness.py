@@ -0,0 +1,235 @@
+"""Query-plan regression harness for the part 2 tasks.
+
+Every query and aggregation issued by the tasks in part2 is explained with executionStats,
+on the server selected by the read preference of the query (e.g. a secondary for the analytics).
+The winning plan, keys/documents examined and the execution time is stored as a baseline,
+and later runs fail if a query starts doing a collection scan,
+or examines more than max_factor times the documents of the baseline.
+
+Usage:
+    python query_plan_harness.py                    # compare against the baseline
+    python query_plan_harness.py --update-baseline  # store a new baseline
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+from collections import Counter
+from DbHandler import DbHandler
+import part2
+
+BASELINE_PATH = "query_plan_baseline.json"
+
+
+class ExplainingDbHandler(DbHandler):
+    """A database handler that explains every query before executing it"""
+
+    def __init__(self):
+        super().__init__()
+        self.plans = {}
+        self.task = None
+        self.nr_query = Counter()  # collection -> queries in the current task
+
+    def find_documents(self, collection_name, query={}, fields={}, read_preference=None):
+        explain = self.explain_find(collection_name, query, fields, read_preference)
+        self._record(collection_name, explain)
+        return super().find_documents(collection_name, query, fields, read_preference)
+
+    def aggregate(self, collection_name, pipeline: list, read_preference=None):
+        explain = self.explain_aggregate(collection_name, pipeline, read_preference)
+        self._record(collection_name, explain)
+        return super().aggregate(collection_name, pipeline, read_preference)
+
+    def get_nr_documents(self, collection_name, read_preference=None) -> int:
+        # count_documents is an aggregation on the server
+        pipeline = [{"$match": {}}, {"$group": {"_id": 1, "n": {"$sum": 1}}}]
+        explain = self.explain_aggregate(collection_name, pipeline, read_preference)
+        self._record(collection_name, explain)
+        return super().get_nr_documents(collection_name, read_preference)
+
+    def _record(self, collection_name, explain: dict):
+        """Store a summary of the explain output for the current task
+
+        Args:
+            collection_name (str): Name of the collection
+            explain (dict): the explain output
+        """
+        # Keyed per collection, so a dropped or new time partition does not shift the other keys
+        self.nr_query[collection_name] += 1
+        summary = summarize_explain(explain)
+        summary["collection"] = collection_name
+        key = f"{self.task}#{collection_name}#{self.nr_query[collection_name]}"
+        self.plans[key] = summary
+
+
+def summarize_explain(explain: dict) -> dict:
+    """Extract the winning plan stages, keys/documents examined and execution time.
+    Works for find, aggregation (with $cursor and $lookup stages) and pushed down pipelines.
+
+    Args:
+        explain (dict): the explain output
+
+    Returns:
+        dict: summary of the explain output
+    """
+    summary = {
+        "stages": set(),
+        "keys_examined": 0,
+        "docs_examined": 0,
+        "execution_time_ms": 0,
+    }
+
+    def collect_stages(plan):
+        if isinstance(plan, dict):
+            if "stage" in plan:
+                summary["stages"].add(plan["stage"])
+            for value in plan.values():
+                collect_stages(value)
+        elif isinstance(plan, list):
+            for value in plan:
+                collect_stages(value)
+
+    def walk(node):
+        if isinstance(node, list):
+            for value in node:
+                walk(value)
+            return
+        if not isinstance(node, dict):
+            return
+
+        # Stage level statistics, e.g. $lookup
+        if node.get("collectionScans", 0) > 0:
+            summary["stages"].add("COLLSCAN")
+        summary["docs_examined"] += node.get("totalDocsExamined", 0)
+        summary["keys_examined"] += node.get("totalKeysExamined", 0)
+        summary["execution_time_ms"] = max(
+            summary["execution_time_ms"], node.get("executionTimeMillisEstimate", 0)
+        )
+
+        for key, value in node.items():
+            if key == "winningPlan":
+                collect_stages(value)
+            elif key == "executionStats":
+                summary["docs_examined"] += value.get("totalDocsExamined", 0)
+                summary["keys_examined"] += value.get("totalKeysExamined", 0)
+                summary["execution_time_ms"] = max(
+                    summary["execution_time_ms"], value.get("executionTimeMillis", 0)
+                )
+            else:
+                walk(value)
+
+    walk(explain)
+    server = explain.get("serverInfo", {})
+    summary["server"] = f"{server.get('host')}:{server.get('port')}"
+    summary["stages"] = sorted(summary["stages"])
+    summary["collscan"] = "COLLSCAN" in summary["stages"]
+    return summary
+
+
+def collect_plans(db: ExplainingDbHandler) -> dict:
+    """Run every part 2 task and collect the plans of their queries
+
+    Args:
+        db (ExplainingDbHandler): The database
+
+    Returns:
+        dict: "<task>#<collection>#<nr>" -> summary of the explain output
+    """
+    for nr, task in part2.TASKS.items():
+        db.task, db.nr_query = f"task_{nr}", Counter()
+        # The printed results are not of interest here
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            task(db)
+    return db.plans
+
+
+def compare_plans(baseline: dict, plans: dict, max_factor: float) -> list:
+    """Compare the plans against the baseline
+
+    Args:
+        baseline (dict): the stored plans
+        plans (dict): the current plans
+        max_factor (float): allowed multiple of the documents examined in the baseline
+
+    Returns:
+        list: description of every regression
+    """
+    regressions = []
+    for query, plan in plans.items():
+        old = baseline.get(query)
+        if old is None:
+            print(f"New query without baseline: {query}")
+            continue
+        if plan["collscan"] and not old["collscan"]:
+            regressions.append(
+                f"{query}: collection scan on {plan['collection']}, was {old['stages']}"
+            )
+        if plan["docs_examined"] > max_factor * max(old["docs_examined"], 1):
+            regressions.append(
+                f"{query}: examined {plan['docs_examined']} documents, "
+                f"baseline is {old['docs_examined']}"
+            )
+    return regressions
+
+
+def print_plans(plans: dict):
+    """Print a summary of the plans
+
+    Args:
+        plans (dict): "<task>#<collection>#<nr>" -> summary of the explain output
+    """
+    from tabulate import tabulate
+
+    rows = [
+        [
+            query,
+            plan["collection"],
+            plan.get("server"),
+            ",".join(plan["stages"]),
+            plan["keys_examined"],
+            plan["docs_examined"],
+            plan["execution_time_ms"],
+        ]
+        for query, plan in plans.items()
+    ]
+    headers = ["Query", "Collection", "Server", "Stages", "Keys", "Docs", "Time (ms)"]
+    print(tabulate(rows, headers=headers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--max-factor", type=float, default=2.0)
+    args = parser.parse_args()
+
+    db = None
+    regressions = []
+    try:
+        db = ExplainingDbHandler()
+        plans = collect_plans(db)
+        print_plans(plans)
+
+        if args.update_baseline or not os.path.exists(args.baseline):
+            with open(args.baseline, "w", encoding="utf-8") as file:
+                json.dump(plans, file, indent=2, sort_keys=True)
+            print(f"Stored baseline in {args.baseline}")
+        else:
+            with open(args.baseline, "r", encoding="utf-8") as file:
+                baseline = json.load(file)
+            regressions = compare_plans(baseline, plans, args.max_factor)
+            for regression in regressions:
+                print("REGRESSION:", regression)
+            if not regressions:
+                print("No query plan regressions")
+    finally:
+        if db:
+            db.connection.close_connection()
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Shows that analytics routed to secondaries do not contend with the ingest.
+
+Starts a local three-member replica set (mongod must be on the PATH),
+and measures the insert latency of a writer while a heavy aggregation runs
+1) nowhere, 2) on the primary and 3) with the analytics read preference.
+Fails if the analytics are not served by a secondary.
+
+Usage: python replica_set_isolation.py [--trackpoints 500000]
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pymongo import MongoClient, WriteConcern
+from DbConnector import DbConnector
+from DbHandler import DbHandler
+
+PORTS = [27117, 27118, 27119]
+REPLICA_SET = "rs0"
+DATABASE = "isolation"
+
+
+def start_replica_set(path) -> list:
+    """Start three mongod processes and initiate the replica set
+
+    Args:
+        path (str): directory for the data files
+
+    Returns:
+        list: the mongod processes
+    """
+    processes = []
+    for port in PORTS:
+        dbpath = f"{path}/{port}"
+        os.makedirs(dbpath)
+        processes.append(
+            subprocess.Popen(
+                [
+                    "mongod",
+                    "--replSet",
+                    REPLICA_SET,
+                    "--port",
+                    str(port),
+                    "--dbpath",
+                    dbpath,
+                    "--bind_ip",
+                    "127.0.0.1",
+                ],
+                stdout=subprocess.DEVNULL,
+            )
+        )
+
+    client = MongoClient(f"mongodb://127.0.0.1:{PORTS[0]}", directConnection=True)
+    for _ in range(60):
+        try:
+            client.admin.command("ping")
+            break
+        except Exception:
+            time.sleep(1)
+    client.admin.command(
+        "replSetInitiate",
+        {
+            "_id": REPLICA_SET,
+            "members": [
+                # Only the first member can become primary
+                {"_id": i, "host": f"127.0.0.1:{port}", "priority": 1 if i == 0 else 0}
+                for i, port in enumerate(PORTS)
+            ],
+        },
+    )
+    client.close()
+    return processes
+
+
+def get_handler() -> DbHandler:
+    """Connect to the replica set through the DbHandler
+
+    Returns:
+        DbHandler: the database
+    """
+    hosts = ",".join(f"127.0.0.1:{port}" for port in PORTS)
+    uri = f"mongodb://{hosts}/{DATABASE}?replicaSet={REPLICA_SET}"
+    connection = DbConnector(DATABASE=DATABASE, URI=uri)
+    db = DbHandler(connection)
+
+    # Wait for a primary and two secondaries
+    for _ in range(60):
+        status = db.client.admin.command("replSetGetStatus")
+        states = sorted(member["stateStr"] for member in status["members"])
+        if states == ["PRIMARY", "SECONDARY", "SECONDARY"]:
+            return db
+        time.sleep(1)
+    raise RuntimeError("The replica set did not start")
+
+
+def fill(db: DbHandler, nr_trackpoints):
+    """Insert trackpoints for the analytics to scan
+
+    Args:
+        db (DbHandler): The database
+        nr_trackpoints (int): number of trackpoints
+    """
+    batch = 10000
+    for start in range(0, nr_trackpoints, batch):
+        db.insert_documents(
+            "TrackPoint",
+            [
+                {
+                    "user_id": f"{random.randrange(182):03}",
+                    "altitude": random.randrange(-777, 3000),
+                    "date_time": datetime.now(),
+                }
+                for _ in range(min(batch, nr_trackpoints - start))
+            ],
+        )
+    # Let the secondaries catch up, replication is in order
+    collection = db.db["TrackPoint"].with_options(write_concern=WriteConcern(w=len(PORTS)))
+    collection.insert_one({"user_id": "000", "altitude": 0, "date_time": datetime.now()})
+
+
+def measure_writes(db: DbHandler, seconds, read_preference=False) -> dict:
+    """Insert small batches while analytics run in another thread
+
+    Args:
+        db (DbHandler): The database
+        seconds (float): duration of the measurement
+        read_preference (ReadPreference | None | bool, optional): where the analytics read,
+            False to not run analytics. Defaults to False.
+
+    Returns:
+        dict: write latencies and the servers that served the analytics
+    """
+    stop = threading.Event()
+    servers = set()
+
+    def analytics():
+        group = {"_id": "$user_id", "n": {"$sum": 1}, "alt": {"$avg": "$altitude"}}
+        pipeline = [{"$group": group}]
+        while not stop.is_set():
+            cursor = db.aggregate("TrackPoint", pipeline, read_preference)
+            list(cursor)
+            servers.add(cursor.address)
+
+    reader = None
+    if read_preference is not False:
+        reader = threading.Thread(target=analytics)
+        reader.start()
+
+    latencies = []
+    end = time.time() + seconds
+    while time.time() < end:
+        docs = [{"user_id": "000", "altitude": 0, "date_time": datetime.now()}] * 100
+        start = time.perf_counter()
+        db.insert_documents("Ingest", [dict(doc) for doc in docs])
+        latencies.append(time.perf_counter() - start)
+
+    stop.set()
+    if reader is not None:
+        reader.join()
+
+    latencies.sort()
+    return {
+        "median_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[int(len(latencies) * 0.99)],
+        "servers": servers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trackpoints", type=int, default=500000)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    if shutil.which("mongod") is None:
+        print("ERROR: mongod is not on the PATH")
+        sys.exit(1)
+
+    path = tempfile.mkdtemp()
+    processes = start_replica_set(path)
+    db = None
+    try:
+        db = get_handler()
+        fill(db, args.trackpoints)
+        primary = db.client.primary
+
+        results = {
+            "no analytics": measure_writes(db, args.seconds),
+            "analytics on primary": measure_writes(db, args.seconds, None),
+            "analytics on secondary": measure_writes(db, args.seconds, db.analytics),
+        }
+        for name, result in results.items():
+            print(
+                f"{name}: write median {result['median_ms']:.2f} ms, "
+                f"p99 {result['p99_ms']:.2f} ms, analytics served by {result['servers']}"
+            )
+
+        if primary in results["analytics on secondary"]["servers"]:
+            print("FAILED: analytics were served by the primary")
+            sys.exit(1)
+        print("Analytics were served by secondaries only")
+    finally:
+        if db:
+            db.connection.close_connection()
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Report on how much trajectory simplification reduces the trackpoint volume,
+and how much the results of task 7 (distance), task 8 (altitude) and task 9 (invalid activities) drift.
+
+The dataset is read directly from disk, so no database is needed.
+Both simplifiers are compared, with the tolerance as the max deviation (douglas_peucker)
+or the min distance between kept points (decimate, with 10 s between kept points).
+Usage: python simplification_report.py [tolerance in meters ...]
+"""
+import os
+import sys
+from haversine import haversine, Unit
+from tabulate import tabulate
+from FileHandler import read_data_file, read_labeled_users_file
+from TrajectorySimplifier import METHODS, get_simplifier
+from part1 import get_datetime_format, get_new_user, match_transportation_mode
+
+
+def walk_distance(data) -> float:
+    """Total distance (km) between consecutive trackpoints, as in task 7"""
+    distance = 0.0
+    for old, new in zip(data, data[1:]):
+        distance += haversine(
+            (float(old[0]), float(old[1])),
+            (float(new[0]), float(new[1])),
+            unit=Unit.KILOMETERS,
+        )
+    return distance
+
+
+def altitude_gain(data) -> int:
+    """Gained altitude (m) between consecutive trackpoints, as in task 8"""
+    gain = 0
+    for old, new in zip(data, data[1:]):
+        old_alt, alt = int(round(float(old[3]))), int(round(float(new[3])))
+        if old_alt < alt and alt != -777 and old_alt != -777:
+            gain += alt - old_alt
+    return gain
+
+
+def invalid_gaps(data) -> int:
+    """Gaps of at least 5 minutes between consecutive trackpoints, as in task 9"""
+    invalid = 0
+    for old, new in zip(data, data[1:]):
+        old_dt = get_datetime_format(old[5], old[6])
+        dt = get_datetime_format(new[5], new[6])
+        if divmod((dt - old_dt).total_seconds(), 60)[0] >= 5:
+            invalid += 1
+    return invalid
+
+
+def simplification_report(simplifiers: dict, path_to_dataset="./dataset") -> dict:
+    """Simplify every activity in the dataset with each simplifier,
+    and compare the results against the original trajectories
+
+    Args:
+        simplifiers (dict): name -> simplifier
+        path_to_dataset (str, optional): path to the dataset. Defaults to "./dataset".
+
+    Returns:
+        dict: name -> {"trackpoints", "distance_112", "altitude", "invalid"}. The original data is stored as "original"
+    """
+    labeled_ids = read_labeled_users_file(
+        os.path.join(path_to_dataset, "labeled_ids.txt")
+    )
+    names = ["original"] + list(simplifiers)
+    results = {
+        name: {"trackpoints": 0, "distance_112": 0.0, "altitude": {}, "invalid": 0}
+        for name in names
+    }
+
+    for root, dirs, files in os.walk(os.path.join(path_to_dataset, "Data")):
+        # New user
+        if len(dirs) > 0 and dirs[0] == "Trajectory":
+            user, labels = get_new_user(root, labeled_ids, files)
+
+        if os.path.normpath(root).split(os.path.sep)[-1] != "Trajectory":
+            continue
+
+        for file in files:
+            data = read_data_file(os.path.join(root, file))[6:]
+            if len(data) > 2500:
+                continue
+
+            # Is this one of the activities in task 7?
+            start_date_time = get_datetime_format(data[0][5], data[0][6])
+            end_date_time = get_datetime_format(data[-1][5], data[-1][6])
+            in_task_7 = (
+                user == "112"
+                and start_date_time.year == 2008
+                and match_transportation_mode(file, end_date_time, labels) == "walk"
+            )
+
+            for name in names:
+                simplified = data if name == "original" else simplifiers[name](data)
+                result = results[name]
+                result["trackpoints"] += len(simplified)
+                result["altitude"][user] = result["altitude"].get(
+                    user, 0
+                ) + altitude_gain(simplified)
+                result["invalid"] += invalid_gaps(simplified)
+                if in_task_7:
+                    result["distance_112"] += walk_distance(simplified)
+
+    return results
+
+
+def print_report(results: dict):
+    """Print the volume reduction and the drift of task 7, task 8 and task 9
+
+    Args:
+        results (dict): output of simplification_report
+    """
+    original = results["original"]
+    top_users = sorted(original["altitude"], key=original["altitude"].get, reverse=True)
+    top_users = top_users[:20]
+
+    rows = []
+    for name, result in results.items():
+        # Relative change of the top 20 altitude gainers
+        drift = [
+            abs(result["altitude"][user] - original["altitude"][user])
+            / max(original["altitude"][user], 1)
+            for user in top_users
+        ]
+        ranking = sorted(result["altitude"], key=result["altitude"].get, reverse=True)
+        rows.append(
+            [
+                name,
+                result["trackpoints"],
+                100 * (1 - result["trackpoints"] / max(original["trackpoints"], 1)),
+                result["distance_112"],
+                100
+                * (result["distance_112"] - original["distance_112"])
+                / max(original["distance_112"], 1e-9),
+                100 * max(drift, default=0),
+                len(set(ranking[:20]) & set(top_users)),
+                result["invalid"],
+                100
+                * (result["invalid"] - original["invalid"])
+                / max(original["invalid"], 1),
+            ]
+        )
+
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "Simplifier",
+                "TrackPoints",
+                "Reduction (%)",
+                "Task 7 (km)",
+                "Task 7 drift (%)",
+                "Task 8 max drift (%)",
+                "Task 8 top 20 kept",
+                "Task 9 invalid",
+                "Task 9 drift (%)",
+            ],
+            floatfmt=".2f",
+        )
+    )
+
+
+def main():
+    tolerances = [float(arg) for arg in sys.argv[1:]] or [1.0, 5.0, 10.0, 25.0]
+    simplifiers = {
+        f"{method}({tolerance}m)": get_simplifier(method, tolerance)
+        for method in METHODS
+        for tolerance in tolerances
+    }
+    print_report(simplification_report(simplifiers))
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,10 @@ class Activity:
     transportation_mode: str
     start_date_time: datetime
     end_date_time: datetime
+    original_nr_trackpoints: int  # Number of trackpoints before simplification
+    year: int  # Year of start_date_time
+    month: int  # Month of start_date_time
+    duration_seconds: float  # end_date_time - start_date_time
 
 
 @dataclass